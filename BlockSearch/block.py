@@ -1,6 +1,7 @@
+from collections import OrderedDict
 from copy import deepcopy
 from enum import Enum
-from random import shuffle
+from itertools import product
 from pprint import pprint as pp
 from memoized import memoized
 # from BlockSearch.piece import Piece
@@ -9,6 +10,7 @@ import numpy as np
 from stl import mesh
 from typing import List, Set, Dict, Tuple, Optional, Generator
 from BlockSearch.render import display, display_multiple_grids, display_colored
+from BlockSearch.footprint import Footprint, Cell_View
 
 X = 0
 Y = 1
@@ -34,6 +36,10 @@ ORIENTATIONS = {
     'flat_thin'     : (90, 90, 0),
     'flat_wide'     : (0, 90, 0)
 }
+# Dense index of every orientation, used to pack descriptors into integer keys
+ORIENTATION_TO_INDEX = {orientation: i for i, orientation in enumerate(ORIENTATIONS.values())}
+INDEX_TO_ORIENTATION = {i: orientation for orientation, i in ORIENTATION_TO_INDEX.items()}
+
 ORIENTATION_LAYING = {
     ORIENTATION.SHORT_THIN.value[0],
     ORIENTATION.FLAT_THIN.value[0],
@@ -47,8 +53,41 @@ ORIENTATION_STANDING = {
 
 block_mesh = mesh.Mesh.from_file('kapla.stl')
 
+# All kapla pieces weigh the same. The kapla mesh is centered around its center of mass, so a block's centroid
+# is its position.
+BLOCK_MASS = float(block_mesh.get_mass_properties()[0])
+
 COVER_THRESHOLD = 0.4
 
+# Maximal number of distinct block geometries kept alive by the block pool
+BLOCK_POOL_SIZE = 2 ** 16
+
+"""
+Every block descriptor (orientation, position) is packed into a single integer key:
+
+    | above (6) | below (6) | context (1) | orientation (3) |     x (20)     |     y (20)     |     z (20)     |
+     75           69          63            62                59               39               19             0
+
+Positions are stored with an offset, so they may be negative, and must lie in [-POSITION_OFFSET, POSITION_OFFSET).
+Descriptor keys fit in 64 bits, so batches of them are kept in uint64 arrays (see Block.gen_keys). Context keys
+describe a block along with the number of neighbors below and above it (see Block.gen_context_key), are wider, and
+never collide with plain descriptor keys.
+"""
+POSITION_BITS       = 20
+POSITION_OFFSET     = 1 << (POSITION_BITS - 1)
+POSITION_MASK       = (1 << POSITION_BITS) - 1
+ORIENTATION_SHIFT   = 3 * POSITION_BITS
+ORIENTATION_MASK    = 0b111
+CONTEXT_FLAG        = 1 << (ORIENTATION_SHIFT + 3)
+BELOW_SHIFT         = ORIENTATION_SHIFT + 4
+ABOVE_SHIFT         = BELOW_SHIFT + 6
+MAX_NEIGHBOR_COUNT  = (1 << 6) - 1
+# Orientation index reserved for floors, so a floor never shares a key with a block
+FLOOR_INDEX         = ORIENTATION_MASK
+
+# Batches of block descriptors are kept in structured arrays, one row per descriptor
+DESCRIPTOR_DTYPE = np.dtype([('orientation', np.int8), ('x', np.int32), ('y', np.int32), ('z', np.int32)])
+
 @memoized
 def init_rotated_mesh(arg):
     orientation = arg
@@ -76,27 +115,10 @@ class Block (Piece):
     """
     SHAPE_IN_CELLS = (1, 15, 3)
 
-
-    def __init__(self):
-        """
-        Used as copy constructor
-        """
-        # super().__init__()
-        self.orientation = None
-        self.position = None
-        self._rendered_mesh = None
-        self._saturated = False
-        self._temp_above        = set()
-        self._str: str        = "Block N/A"
-        self.position           = (-10, -10, -10)
-        self._spreads_memory    = set()
-        self.orientation        = (0, 0, 0)
-        self._rendered_mesh      = mesh.Mesh([])
-        self._original_shape    = mesh.Mesh([])
-        self._quick_data : np.ndarray  = np.array([])
-        self._memoized_aggregate = mesh.Mesh([])
-        self._aggregate_cog     = None
-        self._repr              = "Block N/A"
+    # Everything a block derives from its descriptor lives in its shared geometry, rarely used meshes live in a side
+    # record only allocated once rendered (see Block_Meshes)
+    __slots__ = ('orientation', 'position', '_geometry', '_key', '_cover', '_cog', '_saturated', '_aggregate_cog',
+                 '_aggregate_mass', '_meshes')
 
     def __init__(self, shape : mesh.Mesh, orientation : tuple or str or ORIENTATION, position):
         assert (orientation in ORIENTATIONS or orientation in ORIENTATIONS.values() or type(orientation) == ORIENTATION)
@@ -110,29 +132,22 @@ class Block (Piece):
         super().__init__(shape, orientation, position)
         self.orientation = orientation
         self.position = position
-        self._rendered_mesh = shape
         self._saturated = False
-        self._rendered_mesh = deepcopy(init_rotated_mesh(orientation))
-        self._init_translation()
-        self._original_shape = shape
-        self._spreads_memory = dict()
-        self._temp_above     = set()
-        self._init_shape()
+        self._meshes = None
         self._init_cog()
-        self._init_cells()
-        self._init_levels()
-        self._blocks_below_me   = set()
-        self._block_above_me    = set()
-        self._memoized_aggregate = None
-        self._quick_data = np.array(np.concatenate((self.orientation, self.position)), dtype=np.int16)
-        self._str = Block.gen_str((orientation, position))
-        self._repr = self._get_repr()
+        self._init_geometry()
 
-        self._h = self._quick_data.__hash__
+    def _init_mesh(self) -> mesh.Mesh:
+        """
+        Copies the rotated mesh of this block's orientation, and moves it into place
+        """
+        rendered_mesh = deepcopy(init_rotated_mesh(self.orientation))
+        self._init_translation(rendered_mesh)
+        return rendered_mesh
 
-    def _init_translation(self):
+    def _init_translation(self, rendered_mesh):
         # Translate to correct position. Translations happens from center of the mesh's mass to the objects location
-        for i, translation_obj in enumerate([self._rendered_mesh.x, self._rendered_mesh.y, self._rendered_mesh.z]):
+        for i, translation_obj in enumerate([rendered_mesh.x, rendered_mesh.y, rendered_mesh.z]):
             translation_obj += self.position[i]
 
     def get_cog(self):
@@ -149,9 +164,33 @@ class Block (Piece):
         :return:
         """
         if self._aggregate_cog is None:
-            self.get_aggregate_mesh(state)
+            mass, moment = self.get_aggregate_mass(state)
+            self._aggregate_cog = moment / mass
         return self._aggregate_cog
 
+    def get_mass(self) -> float:
+        return BLOCK_MASS
+
+    def get_aggregate_mass(self, state) -> Tuple[float, np.ndarray]:
+        """
+        Returns the mass and first moment of mass (mass times centroid) of this block and all the blocks above it
+        (recursively). These are sums over blocks, no mesh is involved.
+        Same as the aggregate mesh, a block resting on several supports is accounted for through each of them.
+        :param state:
+        :return: (mass, moment)
+        """
+        if self._aggregate_mass is None:
+            mass = self.get_mass()
+            moment = mass * self._cog
+            blocks_above = state.get_blocks_above(self)
+            if blocks_above:
+                for block in blocks_above:
+                    above_mass, above_moment = block.get_aggregate_mass(state)
+                    mass += above_mass
+                    moment = moment + above_moment
+            self._aggregate_mass = (mass, moment)
+        return self._aggregate_mass
+
     def is_perpendicular(self, other: 'Block' or Tuple[int, int, int] or str):
         """
         Returns if this block is perpendicular to a given block, in some axis
@@ -171,92 +210,70 @@ class Block (Piece):
         :param other: A seperate block to check
         :return:
         """
-        # todo: improve time!
-        return (self.get_cells() & other.get_cells()) != set()
+        return self._geometry.footprint.intersects(other._geometry.footprint)
 
     def get_bottom_level(self) -> int:
         """
         Return the lowest level this block sits in. Anything under this level supports this block
 
         """
-        return self._bottom_level
+        return self._geometry.bottom_level
 
     def get_top_level(self) -> int:
         """
         Return the highest level this block sits in. Anything above this level can be supported by this block.
 
         """
-        return self._top_level
+        return self._geometry.top_level
 
     def get_cover_cells(self) -> Set[Tuple[int, int]]:
         """
         :return: Return a set of 2D cells on XY plane covered by this block
         """
-        return self._cover_cells
+        return self._geometry.get_cover_cells()
 
     def get_cells(self) -> Set[Tuple[int, int, int]]:
-        return self._cells
+        return self._geometry.get_cells()
 
-    def _init_cells(self):
+    def get_footprint(self) -> Footprint:
         """
-
-        :return:
+        :return: The 3D cells this block occupies, as a compact footprint
         """
-        #TODO: convert cells to np array
-        # Set of all the cells contained within this block
-        self._cells = set()
-        # self._cells = np.array
-        # Set of theoretical cells with only X and Y, that are this blocks footprint
-        self._cover_cells = set()
-        cog = tuple(int(i) for i in self.get_cog())
+        return self._geometry.footprint
 
-        half_depth = self.SHAPE_IN_CELLS[X] // 2
-        half_width = self.SHAPE_IN_CELLS[Y] // 2
-        half_height = self.SHAPE_IN_CELLS[Z] // 2
-
-        for x in range(-half_depth, half_depth + 1):
-            for y in range(-half_width, half_width + 1):
-                for z in range(-half_height, half_height + 1):
-                    self._cells.add((cog[X] + x, cog[Y] + y, cog[Z] + z))
-                self._cover_cells.add((cog[X] + x, cog[Y] + y))
-
-    def _init_levels(self):
+    def get_cover(self) -> Footprint:
         """
-        Returns the level (Z height off ground) of the lowest cell in the block
-
-        Standing orientation                   |    Horizontal Orientation
-       ----------------------------------------|---------------------------------------------------------------
-        Top Level ->        X    X X           |
-                            X    X X           |
-                            X    X X           |
-                            X    X X           |                               Top Level ->       X X X X X
-        Bottom Level ->     X    X X           |    B.Level ->    X X X X X                       X X X X X
-
+        :return: The 2D cells on XY plane covered by this block, as a compact footprint
         """
+        return self._cover
 
-        min_z = np.inf
-        max_z = -np.inf
-        for cell in self._cells:
-            if cell[Z] > max_z:
-                max_z = cell[Z]
-            if cell[Z] < min_z:
-                min_z = cell[Z]
-        assert min_z < np.inf
-        assert max_z > -np.inf
-        assert max_z >= min_z
+    def _init_geometry(self):
+        """
+        Shares the interned geometry of this block's descriptor, see Block_Pool
+        """
+        self._set_geometry(BLOCK_POOL.get(self.orientation, self.position))
 
-        self._bottom_level  = int(min_z)
-        self._top_level     = int(max_z)
+    def _set_geometry(self, geometry: 'Block_Geometry'):
+        self._geometry      = geometry
+        # The key and cover are used on every hash and support check, keep them at hand
+        self._cover         = geometry.cover
+        self._key           = geometry.key
 
     def _init_cog(self):
         self._cog               = np.array(self.position)
         self._aggregate_cog       = None  # force to be calculated
-
-    def _init_shape(self):
-        self.SHAPE_IN_CELLS = Block.orient_cells(self.orientation)
+        self._aggregate_mass      = None
 
     @staticmethod
     def orient_cells(orientation):
+        """
+        :return: size of a kapla piece's box in cells, once rotated into orientation
+        """
+        template = ORIENTATION_TEMPLATES.get(orientation)
+        return template.shape_in_cells if template else []
+
+    @staticmethod
+    def _rotate_shape(orientation):
         """
             X X X X X X X X X X X X X X X
             X X X X X X X X X X X X X X X       =>              NO CHANGE
@@ -337,83 +354,47 @@ class Block (Piece):
 
         return new_orientation
 
+    def get_key(self) -> int:
+        """
+        :return: The packed integer key of this block's descriptor, see Block.gen_key
+        """
+        return self._key
+
     def __str__(self):
-        return self._str
+        return self._geometry.get_str()
 
     def __repr__(self):
-        return self._str
-        return self._repr
+        return self.__str__()
 
     def __hash__(self):
-        return self._str.__hash__()
+        return self._key
 
     def __eq__(self, other: 'Block'):
-        return str(other) == str(self)
+        return isinstance(other, Block) and other._key == self._key
 
     def __lt__ (self, other: 'Block'):
-        return str(self) < str(other)
+        return self._key < other._key
 
     def __gt__(self, other: 'Block'):
-        return str(self) > str(other)
+        return self._key > other._key
 
     def __copy__(self):
-        #TODO: can be made to go faster with some fancy copying
+        # Blocks are shared between tower states, all state dependant data is kept by the states
         return self
-        # b = Block(self._original_shape, self.orientation, self.position)
-        b = Block()
-        b.render_mesh      = self._rendered_mesh
-        b._original_shape  = self._original_shape
-        b._spreads_memory  = self._spreads_memory
-        b.SHAPE_IN_CELLS   = self.SHAPE_IN_CELLS
-        b._cog             = self._cog
-        b._memoized_aggregate = np.copy(self._memoized_aggregate)
-        b._cells           = self._cells
-        b._cover_cells     = self._cover_cells
-        b._init_levels()
-
-        # The following needs to be updated later by a larger scale block containing object
-        b._block_above_me  = self._block_above_me
-        b._blocks_below_me = self._blocks_below_me
-
-        # A clean slate is created of block. This block is not responsible of recreating its tree of connectivity.
-        #
-        #   Responsibilities left over:
-        #       blocks above
-        #       blocks below
-        #       spread neighbors
-        #
-        # The aggregate mesh can be innitiated
-
-        return b
-
-    def _set_spread(self, neighbor : 'Block', spread : Set):
-        """
-        Set the inner memory of spreads between object to save on later calculations
-        :param neighbor: the block finished with calculating spread
-        :param spread: the spread set calcualted
-        """
-        assert (neighbor not in self._spreads_memory)
-        self._spreads_memory[neighbor] = spread
 
     def get_aggregate_mesh(self, state):
         """
         Returns a mesh of this object and everything above it.
         :return:
         """
-        if self._memoized_aggregate:
-            return self._memoized_aggregate
-        data = self.get_aggregate_data(state)
-        aggregate = mesh.Mesh(np.concatenate([m.data for m in data]))
-        self._memoized_aggregate = aggregate
-        mp = self._memoized_aggregate.get_mass_properties()
-        # if mp[0] != 45:
-        #     pp(mp)
-        self._aggregate_cog = mp[COG]
-        self._repr = "U" + self._get_repr()
-        return aggregate
+        meshes = self._get_meshes()
+        if meshes.aggregate is None:
+            data = self.get_aggregate_data(state)
+            meshes.aggregate = mesh.Mesh(np.concatenate([m.data for m in data]))
+        return meshes.aggregate
 
     def get_aggregate_data(self, state):
-        data = [self._rendered_mesh]
+        data = [self.render()]
         if state.get_blocks_above(self):
             for block in state.get_blocks_above(self):
                 data.extend(block.get_aggregate_data(state))
@@ -426,8 +407,10 @@ class Block (Piece):
         Signal to self to update the aggregate mesh of all blocks below me. Some change must have occurred above
         :return:
         """
-        self._memoized_aggregate = None
+        if self._meshes is not None:
+            self._meshes.aggregate = None
         self._aggregate_cog      = None
+        self._aggregate_mass     = None
         for block in state.get_blocks_below(self):
             block.reset_aggregate_mesh(state)
 
@@ -435,14 +418,9 @@ class Block (Piece):
         if self._saturated:
             return True
         else:
-            # Refer to blocks directly above me and see if they fill a percentage of my cover space
-            blocks_above = tower_state.get_blocks_above(self)
-            cover_above_me = set()
-            #perform set intersection for all blocks above me
-            for block in blocks_above:
-                cover_above_me  |= block._cover_cells
-            covering_me = self._cover_cells & cover_above_me
-            if len(covering_me) / len(self._cover_cells) > COVER_THRESHOLD:
+            # Refer to the number of my cover cells filled by blocks directly above me, kept by the state
+            covering_me = tower_state.get_covered_cells(self)
+            if covering_me / len(self._cover) > COVER_THRESHOLD:
                 if no_changes:
                     return True
                 self._saturated = True
@@ -456,61 +434,134 @@ class Block (Piece):
                                     default behavior is no limitations
         :return:
         """
+        for descriptor in Block.to_descriptors(self.gen_descriptor_array(limit_orientation=limit_orientation,
+                                                                         limit_len=limit_len,
+                                                                         random_order=random_order)):
+            yield descriptor
+
+    def gen_descriptor_array(self, limit_orientation=lambda o: True, limit_len=60000, random_order=None) -> np.ndarray:
+        """
+        All possible sons of this block as a single array of descriptors (see DESCRIPTOR_DTYPE). A son is any block
+        with at least one cell directly above this block's cover, even if unstable. Sons centered on this block's
+        center lines are left out.
+        :param limit_orientation: function to limit the number of orientations that become sons.
+                                    default behavior is no limitations
+        :param limit_len: maximal number of descriptors returned
+        :param random_order: permute the descriptors randomly
+        :return: array of unique descriptors
+        """
         if self._saturated:
-            return
-        i = 0
-        seen_blocks = set()
+            return np.empty(0, dtype=DESCRIPTOR_DTYPE)
         new_level = self.get_top_level() + 1
-        cover_cells = list(self.get_cover_cells())
+        template = self._geometry.template
+        batches = []
+        for name, orientation in ORIENTATIONS.items():
+            if not limit_orientation(name):
+                continue
+            if template is not None:
+                # Sons of a kapla piece are a translation of its orientation's son table
+                batch = template.son_descriptors[orientation].copy()
+                batch['x'] += self._cog[X]
+                batch['y'] += self._cog[Y]
+                batch['z'] += self._cog[Z]
+                batches.append(batch)
+                continue
+            son_template = ORIENTATION_TEMPLATES[orientation]
+            # Every son position for which the son's box reaches over at least one of my cover cells
+            positions = self._cover.dilate(son_template.half_extents[:Z]).cell_array()
+            positions = positions[(positions[:, X] != self._cog[X]) & (positions[:, Y] != self._cog[Y])]
+            batch = np.empty(len(positions), dtype=DESCRIPTOR_DTYPE)
+            batch['orientation'] = son_template.index
+            batch['x'] = positions[:, X]
+            batch['y'] = positions[:, Y]
+            # Sons rest with their bottom level right above my top level
+            batch['z'] = new_level + son_template.half_extents[Z]
+            batches.append(batch)
+        descriptors = np.concatenate(batches) if batches else np.empty(0, dtype=DESCRIPTOR_DTYPE)
+        if random_order:
+            descriptors = descriptors[np.random.permutation(len(descriptors))]
+        # Same as the generator this replaces, which checked the count after each son: at least one son, and
+        # fractional limits round up
+        return descriptors[:max(1, math.ceil(limit_len))]
+
+    @staticmethod
+    def gen_descriptor_batch(blocks, limit_orientation=lambda block, o: True, limit_len=60000, random_order=None) -> np.ndarray:
+        """
+        Possible sons of a set of father blocks, as a single array of unique descriptors (see DESCRIPTOR_DTYPE).
+        :param blocks: father blocks
+        :param limit_orientation: function of a father block and an orientation name, limits the sons of that father
+        :param limit_len: maximal number of descriptors per father
+        :param random_order: permute the descriptors randomly
+        """
+        batches = [block.gen_descriptor_array(limit_orientation=lambda o: limit_orientation(block, o),
+                                              limit_len=limit_len,
+                                              random_order=random_order)
+                   for block in blocks]
+        if not batches:
+            return np.empty(0, dtype=DESCRIPTOR_DTYPE)
+        descriptors = np.concatenate(batches)
+        # Brothers from different fathers may share descriptors
+        _, unique = np.unique(Block.gen_keys(descriptors), return_index=True)
         if random_order:
-            shuffle(cover_cells)
-        for cell in cover_cells:
-            relevant_keys = list(filter(limit_orientation, ORIENTATIONS.keys()))
-            if random_order:
-                shuffle(relevant_keys)
-            for orientation in relevant_keys:
-                if 'flat' in orientation:
-                    offset = 0
-                elif 'short' in orientation:
-                    offset = 1
-                elif 'tall' in orientation:
-                    offset = 7
-                else:
-                    # should not reach a case with none recognizable orientation
-                    raise AssertionError
-                z = new_level + offset
-                cell_orientation = Block.orient_cells(ORIENTATIONS[orientation])
-                half_depth = cell_orientation[X] // 2
-                half_width = cell_orientation[Y] // 2
-                xrange = list(range(-half_depth + cell[X], (half_depth + 1) + cell[X]))
-                yrange = list(range(-half_width + cell[Y], (half_width + 1) + cell[Y]))
-                if random_order:
-                    shuffle(xrange)
-                    shuffle(yrange)
-                for x in xrange:
-                    for y in yrange:
-                        if x == self._cog[X] or y == self._cog[Y]:
-                            continue
-                        candidate = (ORIENTATIONS[orientation], (x, y, z))
-                        if candidate not in seen_blocks:
-                            yield candidate
-                            i += 1
-                            if i >= limit_len:
-                                return
-                            if self._saturated:
-                                return
-                        seen_blocks.add(candidate)
-
-    def _get_repr(self) -> str:
-        """
-        Heavier calculation of repr, do be done less often, only upon changes to COG.
-        """
-        if self._aggregate_cog is not None:
-            return "Block: O{}, P{}, A_COG{}".format(str(self.orientation),
-                                                     str(self.position),
-                                                     str(tuple(self._aggregate_cog.astype(np.int))))
-        return "Block: O{}, P{}, A_COG(N/A)".format(str(self.orientation),
-                                                 str(self.position))
+            return descriptors[np.random.permutation(unique)]
+        return descriptors[np.sort(unique)]
+
+    @staticmethod
+    def gen_keys(descriptors: np.ndarray) -> np.ndarray:
+        """
+        Vectorized gen_key, packs an array of descriptors (see DESCRIPTOR_DTYPE) into an array of keys
+        """
+        for axis in ('x', 'y', 'z'):
+            assert not len(descriptors) or (-POSITION_OFFSET <= descriptors[axis].min() and
+                                            descriptors[axis].max() < POSITION_OFFSET), "Position out of key range"
+        keys = descriptors['orientation'].astype(np.uint64) << np.uint64(ORIENTATION_SHIFT)
+        keys |= (descriptors['x'] + POSITION_OFFSET).astype(np.uint64) << np.uint64(2 * POSITION_BITS)
+        keys |= (descriptors['y'] + POSITION_OFFSET).astype(np.uint64) << np.uint64(POSITION_BITS)
+        keys |= (descriptors['z'] + POSITION_OFFSET).astype(np.uint64)
+        return keys
+
+    @staticmethod
+    def to_descriptors(descriptors: np.ndarray) -> List[tuple]:
+        """
+        Converts an array of descriptors (see DESCRIPTOR_DTYPE) into a list of (orientation, position) descriptors
+        """
+        return [(INDEX_TO_ORIENTATION[orientation], (x, y, z)) for orientation, x, y, z in descriptors.tolist()]
+
+    @staticmethod
+    def gen_key(descriptor) -> int:
+        """
+        Packs a block descriptor into a single integer, without building a block or a string.
+        Ordering of keys is by orientation, then x, y and z.
+        """
+        orientation, position = descriptor
+        assert -POSITION_OFFSET <= position[X] < POSITION_OFFSET and -POSITION_OFFSET <= position[Y] < POSITION_OFFSET \
+            and -POSITION_OFFSET <= position[Z] < POSITION_OFFSET, "Position out of key range " + str(position)
+        return (ORIENTATION_TO_INDEX[orientation] << ORIENTATION_SHIFT) | \
+               ((position[X] + POSITION_OFFSET) << (2 * POSITION_BITS)) | \
+               ((position[Y] + POSITION_OFFSET) << POSITION_BITS) | \
+               (position[Z] + POSITION_OFFSET)
+
+    @staticmethod
+    def parse_key(key: int):
+        """
+        Unpacks a key created by gen_key back into a block descriptor
+        """
+        orientation = INDEX_TO_ORIENTATION[(key >> ORIENTATION_SHIFT) & ORIENTATION_MASK]
+        position = (((key >> (2 * POSITION_BITS)) & POSITION_MASK) - POSITION_OFFSET,
+                    ((key >> POSITION_BITS) & POSITION_MASK) - POSITION_OFFSET,
+                    (key & POSITION_MASK) - POSITION_OFFSET)
+        return orientation, position
+
+    @staticmethod
+    def gen_context_key(key: int, num_below: int, num_above: int) -> int:
+        """
+        A block state can be uniquely described by a block descriptor, along with the number or neighbors above and
+        below. Counts beyond MAX_NEIGHBOR_COUNT are saturated.
+        :param key: key of the block's descriptor
+        """
+        return key | CONTEXT_FLAG | \
+               (min(num_below, MAX_NEIGHBOR_COUNT) << BELOW_SHIFT) | \
+               (min(num_above, MAX_NEIGHBOR_COUNT) << ABOVE_SHIFT)
 
     @staticmethod
     def gen_str(descriptor) -> str:
@@ -522,15 +573,213 @@ class Block (Piece):
 
     def render(self):
         """
-        Draw the piece
+        Draw the piece. The mesh is built on the first call, most blocks are never rendered.
         :return: A mesh oriented and positioned in 3D space
         """
-        return self._rendered_mesh
+        meshes = self._get_meshes()
+        if meshes.rendered is None:
+            meshes.rendered = self._init_mesh()
+        return meshes.rendered
+
+    def _get_meshes(self) -> 'Block_Meshes':
+        if self._meshes is None:
+            self._meshes = Block_Meshes()
+        return self._meshes
+
+
+class Block_Meshes():
+    """
+    Meshes of a single block, only needed for display. Kept apart from the block, most blocks are never rendered.
+    """
+    __slots__ = ('rendered', 'aggregate')
+
+    def __init__(self):
+        self.rendered = None
+        self.aggregate = None
+
+
+class Block_Geometry():
+    """
+    Everything about a block that follows from its descriptor (orientation, position) alone.
+    Geometries are immutable, and shared by all blocks with the same descriptor through the Block_Pool.
+    """
+    __slots__ = ('orientation', 'position', 'template', 'shape_in_cells', 'footprint', 'cover', 'bottom_level',
+                 'top_level', 'key', '_str', '_cells', '_cover_cells')
+
+    def __init__(self, orientation, position, shape_in_cells=None, footprint: Footprint = None, key: int = None):
+        """
+        :param shape_in_cells: size of the block's box, defaults to a kapla piece rotated into orientation
+        :param footprint: cells of the block, defaults to a full box of shape_in_cells around position
+        :param key: packed key of the block, defaults to the key of its descriptor
+        """
+        self.orientation = orientation
+        self.position = position
+        # Only kapla pieces follow the template of their orientation
+        self.template = None if shape_in_cells else ORIENTATION_TEMPLATES[orientation]
+        if self.template is not None:
+            self.shape_in_cells = self.template.shape_in_cells
+            if footprint is None:
+                footprint = self.template.place(position)
+        else:
+            self.shape_in_cells = shape_in_cells
+        if footprint is None:
+            cog = tuple(int(i) for i in position)
+            half_depth = self.shape_in_cells[X] // 2
+            half_width = self.shape_in_cells[Y] // 2
+            half_height = self.shape_in_cells[Z] // 2
+            footprint = Footprint((cog[X] - half_depth, cog[Y] - half_width, cog[Z] - half_height),
+                                  (2 * half_depth + 1, 2 * half_width + 1, 2 * half_height + 1))
+        self.footprint = footprint
+        # Theoretical cells with only X and Y, that are this blocks footprint
+        self.cover = footprint.project()
+
+        """
+        Level (Z height off ground) of the lowest and highest cells in the block
+
+        Standing orientation                   |    Horizontal Orientation
+       ----------------------------------------|---------------------------------------------------------------
+        Top Level ->        X    X X           |
+                            X    X X           |
+                            X    X X           |
+                            X    X X           |                               Top Level ->       X X X X X
+        Bottom Level ->     X    X X           |    B.Level ->    X X X X X                       X X X X X
+
+        """
+        self.bottom_level = footprint.get_origin()[Z]
+        self.top_level = footprint.get_end()[Z] - 1
+        assert self.top_level >= self.bottom_level
+
+        self.key = key if key is not None else Block.gen_key((orientation, position))
+        # Strings and cell sets are only materialized upon request
+        self._str = None
+        self._cells = None
+        self._cover_cells = None
+
+    def get_str(self) -> str:
+        if self._str is None:
+            self._str = Block.gen_str((self.orientation, self.position))
+        return self._str
+
+    def get_cells(self) -> Set[Tuple[int, int, int]]:
+        if self._cells is None:
+            if self.template is not None:
+                x, y, z = (int(i) for i in self.position)
+                self._cells = {(x + dx, y + dy, z + dz) for dx, dy, dz in self.template.cell_offsets}
+            else:
+                self._cells = self.footprint.cells()
+        return self._cells
+
+    def get_cover_cells(self) -> Set[Tuple[int, int]]:
+        if self._cover_cells is None:
+            if self.template is not None:
+                x, y = (int(i) for i in self.position[:Z])
+                self._cover_cells = {(x + dx, y + dy) for dx, dy in self.template.cover_offsets}
+            else:
+                self._cover_cells = self.cover.cells()
+        return self._cover_cells
+
+
+class Orientation_Template():
+    """
+    Everything about a kapla piece that follows from its orientation alone, relative to the piece's position.
+    Templates are computed once per orientation, see ORIENTATION_TEMPLATES.
+    """
+    __slots__ = ('orientation', 'index', 'shape_in_cells', 'half_extents', 'cell_offsets', 'cover_offsets',
+                 'bottom_offset', 'top_offset', 'son_descriptors')
+
+    def __init__(self, orientation):
+        self.orientation = orientation
+        self.index = ORIENTATION_TO_INDEX[orientation]
+        self.shape_in_cells = Block._rotate_shape(orientation)
+        self.half_extents = tuple(size // 2 for size in self.shape_in_cells)
+        self.cell_offsets = tuple(product(*(range(-half, half + 1) for half in self.half_extents)))
+        self.cover_offsets = tuple(product(*(range(-half, half + 1) for half in self.half_extents[:Z])))
+        # Levels of the lowest and highest cells, relative to the piece's position
+        self.bottom_offset = -self.half_extents[Z]
+        self.top_offset = self.half_extents[Z]
+        # Filled in once all templates exist, see init_son_descriptors
+        self.son_descriptors = None
+
+    def place(self, position) -> Footprint:
+        """
+        :return: footprint of a kapla piece of this orientation at position
+        """
+        return Footprint(tuple(int(i) - half for i, half in zip(position, self.half_extents)), self.shape_in_cells)
+
+    def init_son_descriptors(self, templates):
+        """
+        Tables all sons of a kapla piece of this orientation sitting at the origin, for every orientation of sons.
+        A son is any piece with at least one cell directly above the cover, which is not centered on its center lines.
+        Sons of a piece elsewhere are a translation of this table.
+        """
+        cover = self.place((0, 0, 0)).project()
+        self.son_descriptors = dict()
+        for orientation, son_template in templates.items():
+            positions = cover.dilate(son_template.half_extents[:Z]).cell_array()
+            positions = positions[(positions[:, X] != 0) & (positions[:, Y] != 0)]
+            descriptors = np.empty(len(positions), dtype=DESCRIPTOR_DTYPE)
+            descriptors['orientation'] = son_template.index
+            descriptors['x'] = positions[:, X]
+            descriptors['y'] = positions[:, Y]
+            # Sons rest with their bottom level right above the top level
+            descriptors['z'] = self.top_offset + 1 + son_template.half_extents[Z]
+            descriptors.setflags(write=False)
+            self.son_descriptors[orientation] = descriptors
+
+
+ORIENTATION_TEMPLATES = {orientation: Orientation_Template(orientation) for orientation in ORIENTATIONS.values()}
+for _template in ORIENTATION_TEMPLATES.values():
+    _template.init_son_descriptors(ORIENTATION_TEMPLATES)
+
+
+class Block_Pool():
+    """
+    Process wide intern pool of block geometries, keyed by descriptor. Asking twice for the same descriptor returns
+    the same geometry object. The pool is bounded, least recently used geometries are dropped first.
+    """
+
+    def __init__(self, max_size=BLOCK_POOL_SIZE):
+        self._geometries: Dict[tuple, Block_Geometry] = OrderedDict()
+        self._max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, orientation, position) -> Block_Geometry:
+        descriptor = (orientation, position)
+        geometry = self._geometries.get(descriptor)
+        if geometry is not None:
+            self.hits += 1
+            self._geometries.move_to_end(descriptor)
+            return geometry
+        self.misses += 1
+        geometry = Block_Geometry(orientation, position)
+        self._geometries[descriptor] = geometry
+        if len(self._geometries) > self._max_size:
+            self._geometries.popitem(last=False)
+        return geometry
+
+    def clear(self):
+        self._geometries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def __repr__(self):
+        return "Block Pool: size {}, hits {}, misses {}".format(len(self), self.hits, self.misses)
+
+
+BLOCK_POOL = Block_Pool()
+
+FLOOR_KEY = FLOOR_INDEX << ORIENTATION_SHIFT
 
 
 class RingFloor(Block):
+    __slots__ = ('_floor_mesh', '_size', '_ring_size', '_number_of_rings', '_distance_between_rings', '_str')
+
     def __init__(self, floor_mesh, size=30, ring_size=15, number_of_rings=1, distance_between_rings=10):
-        self.SHAPE_IN_CELLS = (size, size, 1)
+        self._floor_mesh = floor_mesh
         self._size = size
         self._ring_size = ring_size
         self._number_of_rings = number_of_rings
@@ -538,58 +787,97 @@ class RingFloor(Block):
         self._str = "Ring Floor: size {}".format(size)
 
         super().__init__(shape=floor_mesh, orientation=(0, 0, 0 ), position=(0, 0, 0 ))
-        self._rendered_mesh = floor_mesh
+
+    def render(self):
+        return self._floor_mesh
+
+    def _init_geometry(self):
+        # A floor is not a kapla piece, it is never interned
+        self._init_cells()
+
+    def __str__(self):
+        return self._str
 
     def get_size(self):
         return self._size
 
-    def _init_cells(self):
-        #TODO: convert cells to np array
-        # Set of all the cells contained within this block
-        self._cells = set()
-        # self._cells = np.array
-        # Set of theoretical cells with only X and Y, that are this blocks footprint
-        self._cover_cells = set()
+    def _gen_ring_distances(self) -> Generator[Set[int], None, None]:
+        """
+        :return: For every ring, the distances from the center of the cells it is made of
+        """
+        for i, l in enumerate(range(self._size//4, self._size, self._distance_between_rings)):
+            yield set(range(l - math.floor(self._ring_size / 2.0), l + math.ceil(self._ring_size / 2.0)))
+            if i >= self._number_of_rings:
+                break
+
+    def _ring_footprint(self, ring_distances: Set[int]) -> Footprint:
+        """
+        :return: 3D footprint of the floor's cells whose distance from the center is one of the given distances
+        """
         cog = tuple(int(i) for i in self.get_cog())
 
         half_depth = self._size // 2
         half_width = self._size // 2
         half_height = 0
 
+        # Distance of every cell in the floor's box from the center, all at once
+        x, y, z = np.ogrid[-half_depth:half_depth + 1, -half_width:half_width + 1, -half_height:half_height + 1]
+        dist = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+        ring_distances = np.array(sorted(ring_distances))
+        mask = np.isin(np.floor(dist), ring_distances) | np.isin(np.ceil(dist), ring_distances)
+        return Footprint((cog[X] - half_depth, cog[Y] - half_width, cog[Z] - half_height), mask.shape, mask)
+
+    def _init_cells(self):
         ring_distances = set()
-        for i, l in enumerate(range(self._size//4, self._size, self._distance_between_rings)):
-            ring_distances |= set(range(l - math.floor(self._ring_size / 2.0), l + math.ceil(self._ring_size / 2.0)))
-            if i >= self._number_of_rings:
-                break
-        print(ring_distances)
-
-        for x in range(-half_depth, half_depth + 1):
-            for y in range(-half_width, half_width + 1):
-                for z in range(-half_height, half_height + 1):
-                    posish = (x, y, z)
-                    dist = np.linalg.norm((posish, (0, 0, 0)))
-                    # if dist >= self._size / 2 - 3 and dist <= self._size / 2:
-                    if math.floor(dist) in ring_distances or math.ceil(dist) in ring_distances:
-                        self._cells.add((cog[X] + x, cog[Y] + y, cog[Z] + z))
-                        self._cover_cells.add((cog[X] + x, cog[Y] + y))
+        for distances in self._gen_ring_distances():
+            ring_distances |= distances
+
+        # The ring does not fill its bounding box, so the footprint keeps an occupancy mask
+        self._set_geometry(Block_Geometry(self.orientation, self.position, (self._size, self._size, 1),
+                                          self._ring_footprint(ring_distances), key=FLOOR_KEY))
+
+    def get_ring_covers(self) -> List[Footprint]:
+        """
+        :return: The 2D cells on XY plane of every ring, from the innermost ring out. Rings may share cells
+        """
+        return [self._ring_footprint(distances).project() for distances in self._gen_ring_distances()]
 
     def __repr__(self):
         return self._str
 
 class Floor(Block):
+    __slots__ = ('_floor_mesh', '_size', '_str', '_footprint_view', '_cover_view')
 
     def __init__(self, floor_mesh, size=30):
-        super().__init__(shape=floor_mesh, orientation=(0, 0, 0 ), position=(0, 0, 0 ))
-        self.SHAPE_IN_CELLS = (size, size, 1)
-        self._rendered_mesh = floor_mesh
+        self._floor_mesh = floor_mesh
         self._size = size
-        self._init_cells()
-        self._init_levels()
+        super().__init__(shape=floor_mesh, orientation=(0, 0, 0 ), position=(0, 0, 0 ))
         self._str = "Floor: size {}".format(size)
+        self._footprint_view = self.get_footprint().view()
+        self._cover_view = self.get_cover().view()
+
+    def _init_geometry(self):
+        # A floor is not a kapla piece, it is never interned
+        self._set_geometry(Block_Geometry(self.orientation, self.position, (self._size, self._size, 1), key=FLOOR_KEY))
+
+    def render(self):
+        return self._floor_mesh
+
+    def get_cells(self) -> Cell_View:
+        """
+        A floor is a full rectangle, its cells are answered from its bounds and never stored
+        """
+        return self._footprint_view
+
+    def get_cover_cells(self) -> Cell_View:
+        return self._cover_view
 
     def get_size(self):
         return self._size
 
+    def __str__(self):
+        return self._str
+
     def __repr__(self):
         return self._str
 
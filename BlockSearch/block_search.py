@@ -1,11 +1,12 @@
 from copy import copy
 from random import shuffle
 
+import numpy as np
 from stl import mesh
 
 from BlockSearch.search import SearchProblem
 from BlockSearch.tower_state import Tower_State
-from BlockSearch.block import Block
+from BlockSearch.block import Block, BLOCK_POOL
 from typing import List, Set, Dict, Tuple, Optional, Generator
 from pprint import pprint as pp
 from BlockSearch.render import display
@@ -79,7 +80,7 @@ class Block_Search(SearchProblem):
                 for desc in son_descriptors:
                     if len(actions) > self._num_of_blocks_in_action:
                         break
-                    if state.is_bad_block(Block.gen_str(desc)):
+                    if state.is_bad_block(Block.gen_key(desc)):
                         self._num_of_descriptors_disqualified += 1
                     else:  # good block description, lets try it out
                         blocks = [Block(BLOCK_MESH, *desc)]
@@ -87,7 +88,7 @@ class Block_Search(SearchProblem):
                             sub_descriptors = Block_Search.propagate(*desc, dist=self._symmetrical_base_distance)
                             # qualified_symmetrical_brothers = len(sub_descriptors)
                             for sym_desc in sub_descriptors:
-                                if state.is_bad_block(Block.gen_str(desc)):
+                                if state.is_bad_block(Block.gen_key(desc)):
                                     self._num_of_descriptors_disqualified += 1
                                     # qualified_symmetrical_brothers -= 1
                                 else:
@@ -154,24 +155,25 @@ class Cover_Block_Search(Block_Search):
 
         print("Building succesors for state of height:{}".format(tower_state._max_level))
         pp(tower_state)
-        all_possible_son_desc = []
+        father_blocks = []
         for father_block in tower_state.gen_blocks(no_floor=False, filter_saturated_block=False):
             if father_block.is_saturated(tower_state):
                 self._num_of_blocks_saturated += 1
                 continue
-            all_possible_son_desc.extend(filter(
-                lambda desc: not tower_state.is_bad_block(Block.gen_str(desc)),
-                father_block.gen_possible_block_descriptors(
-                      limit_orientation=lambda o: father_block.is_perpendicular(o),
-                      limit_len=self._limit_sons,
-                      random_order=self._gen_randomly
-                )
-            )
-            )
-        if self._gen_randomly:
-            shuffle(all_possible_son_desc)
-        else:
-            all_possible_son_desc.sort(key=lambda desc: desc[1][Z], reverse=True)
+            father_blocks.append(father_block)
+        son_descriptors = Block.gen_descriptor_batch(
+            dict.fromkeys(father_blocks),
+            limit_orientation=lambda father_block, o: father_block.is_perpendicular(o),
+            limit_len=self._limit_sons,
+            random_order=self._gen_randomly
+        )
+        son_descriptors = son_descriptors[[not tower_state.is_bad_block(key)
+                                           for key in Block.gen_keys(son_descriptors).tolist()]]
+        if not self._gen_randomly:
+            # Sons are popped from the end of the list, lowest first
+            son_descriptors = son_descriptors[np.argsort(-son_descriptors['z'], kind='stable')]
+        all_possible_son_desc = Block.to_descriptors(son_descriptors)
+        nogoods = tower_state.get_nogoods()
         for _ in range(self._limit_branching):
             new_tower = copy(tower_state)
             actions = []
@@ -180,13 +182,17 @@ class Cover_Block_Search(Block_Search):
                     desc = all_possible_son_desc.pop()
                 else:
                     break
-                if tower_state.is_bad_block(Block.gen_str(desc)):
+                if tower_state.is_bad_block(Block.gen_key(desc)):
                     self._num_of_descriptors_disqualified += 1
                     continue
                 son_block = Block(BLOCK_MESH, *desc)
+                nogood_hits = nogoods.hits
                 if new_tower.can_add(son_block):
                     new_tower.add(son_block)
                     actions.append(son_block)
+                elif nogoods.hits > nogood_hits:
+                    # failed in another state with the same neighbors, no stability check took place
+                    self._num_of_descriptors_disqualified += 1
                 else:
                     self._num_of_blocks_disqualified += 1
             if actions:
@@ -205,6 +211,8 @@ class Cover_Block_Search(Block_Search):
             self._num_of_blocks_disqualified,
             self._num_of_blocks_saturated
         ))
+        print("\t{}".format(BLOCK_POOL))
+        print("\t{}".format(nogoods))
         #eturn successors
 
     series1 = [-1, 1, -1, 1]
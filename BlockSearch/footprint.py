@@ -0,0 +1,559 @@
+from collections.abc import Set as AbstractSet
+from itertools import product
+from typing import Set, Tuple, Iterable, Iterator, Optional
+
+import numpy as np
+
+from BlockSearch.persistent import PMap, EMPTY_PMAP
+
+X = 0
+Y = 1
+Z = 2
+# Voxel grids are split into cubic chunks of CHUNK_SIZE cells along every axis, see Voxel_Grid. Cell tiles are split
+# into square chunks of the same size, see Cell_Tiles
+CHUNK_BITS = 3
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+
+
+class Footprint():
+    """
+    A compact description of the grid cells an object occupies.
+
+    The cells are bound by an integer axis aligned box (origin and shape, in cells). Objects that fill their box
+    entirely (every kapla piece) store nothing else. Objects that do not fill their box (a ring floor) keep an
+    occupancy mask of the box, packed into bits.
+
+    Works for 3D cells (x, y, z) as well as for 2D cells (x, y) on the XY plane.
+
+                    origin + shape
+            +---------+
+            | X X X X |
+            | X     X |     <- masked box, only X cells are occupied
+            | X X X X |
+            +---------+
+        origin
+    """
+
+    def __init__(self, origin: Tuple[int, ...], shape: Tuple[int, ...], mask: Optional[np.ndarray] = None):
+        """
+        :param origin: lowest cell in the box, in every axis
+        :param shape: number of cells in the box along every axis
+        :param mask: optional boolean array of the given shape. None means the box is full.
+        """
+        assert len(origin) == len(shape)
+        self._origin = tuple(int(i) for i in origin)
+        self._shape = tuple(int(i) for i in shape)
+        self._end = tuple(o + s for o, s in zip(self._origin, self._shape))
+        self._mask = None
+        self._chunks = None
+        if mask is None or mask.all():
+            self._packed = None
+            self._size = int(np.prod(self._shape))
+        else:
+            assert mask.shape == self._shape
+            self._packed = np.packbits(mask, axis=None)
+            self._size = int(np.count_nonzero(mask))
+
+    @staticmethod
+    def from_cells(cells: Iterable[Tuple[int, ...]]) -> 'Footprint':
+        """
+        Builds the tightest footprint holding the given cells
+        """
+        cells = np.array(list(cells), dtype=np.int64)
+        assert cells.size, "Cannot build a footprint without any cells"
+        origin = cells.min(axis=0)
+        shape = cells.max(axis=0) - origin + 1
+        mask = np.zeros(shape, dtype=bool)
+        mask[tuple((cells - origin).T)] = True
+        return Footprint(origin, shape, mask)
+
+    def get_origin(self) -> Tuple[int, ...]:
+        return self._origin
+
+    def get_shape(self) -> Tuple[int, ...]:
+        return self._shape
+
+    def get_end(self) -> Tuple[int, ...]:
+        """
+        :return: The first cell past the box, in every axis (exclusive bound)
+        """
+        return self._end
+
+    def is_solid(self) -> bool:
+        """
+        :return: True iff every cell in the bounding box is occupied
+        """
+        return self._packed is None
+
+    def get_mask(self) -> np.ndarray:
+        """
+        :return: Boolean occupancy array over the bounding box
+        """
+        if self._packed is None:
+            return np.ones(self._shape, dtype=bool)
+        return np.unpackbits(self._packed)[:self._size_of_box()].reshape(self._shape).astype(bool)
+
+    def _size_of_box(self) -> int:
+        return int(np.prod(self._shape))
+
+    def _window(self, other: 'Footprint'):
+        """
+        Intersection of both bounding boxes.
+        :return: (low, high) corners of the common box, high is exclusive. None if the boxes are apart.
+        """
+        low = tuple(max(a, b) for a, b in zip(self._origin, other._origin))
+        high = tuple(min(a, b) for a, b in zip(self._end, other._end))
+        for l, h in zip(low, high):
+            if l >= h:
+                return None
+        return low, high
+
+    def _mask_at(self, low, high) -> Optional[np.ndarray]:
+        """
+        Occupancy of this footprint inside a sub box. None stands for a full sub box.
+        """
+        if self._packed is None:
+            return None
+        if self._mask is None:
+            # Masked footprints are few (floors) and queried often, keep them unpacked once looked up
+            self._mask = self.get_mask()
+        return self._mask[tuple(slice(l - o, h - o) for l, h, o in zip(low, high, self._origin))]
+
+    def _common_mask(self, other: 'Footprint', window) -> Optional[np.ndarray]:
+        low, high = window
+        mine = self._mask_at(low, high)
+        theirs = other._mask_at(low, high)
+        if mine is None:
+            return theirs
+        if theirs is None:
+            return mine
+        return mine & theirs
+
+    def intersects(self, other: 'Footprint') -> bool:
+        """
+        Returns true if at least one cell is occupied by both footprints
+        """
+        if self._packed is None and other._packed is None:
+            # Two full boxes meet iff their bounds overlap along every axis
+            for low, high, other_low, other_high in zip(self._origin, self._end, other._origin, other._end):
+                if low >= other_high or other_low >= high:
+                    return False
+            return True
+        window = self._window(other)
+        if window is None:
+            return False
+        common = self._common_mask(other, window)
+        return common is None or bool(common.any())
+
+    def intersection_size(self, other: 'Footprint') -> int:
+        """
+        :return: Number of cells occupied by both footprints
+        """
+        window = self._window(other)
+        if window is None:
+            return 0
+        common = self._common_mask(other, window)
+        if common is None:
+            low, high = window
+            return int(np.prod([h - l for l, h in zip(low, high)]))
+        return int(np.count_nonzero(common))
+
+    def covered_by(self, others: Iterable['Footprint']) -> int:
+        """
+        :return: Number of cells in this footprint that are occupied by at least one of the given footprints
+        """
+        covered = np.zeros(self._shape, dtype=bool)
+        for other in others:
+            window = self._window(other)
+            if window is None:
+                continue
+            low, high = window
+            theirs = other._mask_at(low, high)
+            covered[tuple(slice(l - o, h - o) for l, h, o in zip(low, high, self._origin))] |= \
+                True if theirs is None else theirs
+        if self._packed is not None:
+            covered &= self.get_mask()
+        return int(np.count_nonzero(covered))
+
+    def contains(self, cell: Tuple[int, ...]) -> bool:
+        """
+        Returns true if the given cell is occupied by this footprint
+        """
+        for c, o, e in zip(cell, self._origin, self._end):
+            if not o <= c < e:
+                return False
+        if self._packed is None:
+            return True
+        if self._mask is None:
+            self._mask = self.get_mask()
+        return bool(self._mask[tuple(int(c) - o for c, o in zip(cell, self._origin))])
+
+    def project(self) -> 'Footprint':
+        """
+        Projects a 3D footprint onto the XY plane
+        :return: 2D footprint of all (x, y) cells with at least one occupied cell above or below them.
+        """
+        assert len(self._shape) == 3
+        if self._packed is None:
+            return Footprint(self._origin[:Z], self._shape[:Z])
+        return Footprint(self._origin[:Z], self._shape[:Z], self.get_mask().any(axis=Z))
+
+    def dilate(self, half_extents: Tuple[int, ...]) -> 'Footprint':
+        """
+        Grows the footprint by a box, the Minkowski sum of this footprint with a box of size 2 * half_extents + 1.
+        :return: Footprint of all cells within half_extents (along every axis) of an occupied cell
+        """
+        origin = tuple(o - h for o, h in zip(self._origin, half_extents))
+        shape = tuple(s + 2 * h for s, h in zip(self._shape, half_extents))
+        if self._packed is None:
+            return Footprint(origin, shape)
+        # A box is separable, dilate along one axis at a time
+        mask = self.get_mask()
+        for axis, half in enumerate(half_extents):
+            if half == 0:
+                continue
+            grown_shape = list(mask.shape)
+            grown_shape[axis] += 2 * half
+            grown = np.zeros(grown_shape, dtype=bool)
+            for shift in range(2 * half + 1):
+                window = [slice(None)] * mask.ndim
+                window[axis] = slice(shift, shift + mask.shape[axis])
+                grown[tuple(window)] |= mask
+            mask = grown
+        return Footprint(origin, shape, mask)
+
+    def cell_array(self) -> np.ndarray:
+        """
+        :return: Integer array of all occupied cells, one row per cell, in lexicographic order
+        """
+        if self._packed is None:
+            occupied = np.indices(self._shape).reshape(len(self._shape), -1).T
+        else:
+            occupied = np.argwhere(self.get_mask())
+        return occupied + np.array(self._origin)
+
+    def gen_cells(self) -> Iterator[Tuple[int, ...]]:
+        """
+        Iterates over all occupied cells, as integer tuples, in lexicographic order
+        """
+        if self._packed is None:
+            return product(*(range(o, e) for o, e in zip(self._origin, self._end)))
+        return map(tuple, self.cell_array().tolist())
+
+    def chunks(self) -> Tuple[Tuple[Tuple[int, ...], int], ...]:
+        """
+        Splits a 3D footprint into the chunks of a voxel grid (see Voxel_Grid), or a 2D footprint into the chunks of
+        cell tiles (see Cell_Tiles)
+        :return: (chunk, bits) pairs, bits are the occupied cells of the footprint within the chunk
+        """
+        if self._chunks is None:
+            if self._packed is None:
+                chunks = []
+                chunk_ranges = [range(o >> CHUNK_BITS, ((e - 1) >> CHUNK_BITS) + 1)
+                                for o, e in zip(self._origin, self._end)]
+                for chunk in product(*chunk_ranges):
+                    # The part of the box within the chunk, in cells relative to the chunk
+                    low = [max(o - (c << CHUNK_BITS), 0) for o, c in zip(self._origin, chunk)]
+                    high = [min(e - (c << CHUNK_BITS), CHUNK_SIZE) for e, c in zip(self._end, chunk)]
+                    chunks.append((chunk, _box_bits(low, high)))
+            else:
+                bits_by_chunk = dict()
+                for cell in self.cell_array().tolist():
+                    chunk = tuple(c >> CHUNK_BITS for c in cell)
+                    bits_by_chunk[chunk] = bits_by_chunk.get(chunk, 0) | (1 << _bit_of(c & CHUNK_MASK for c in cell))
+                chunks = bits_by_chunk.items()
+            self._chunks = tuple(chunks)
+        return self._chunks
+
+    def view(self) -> 'Cell_View':
+        """
+        :return: A read only set of all occupied cells, which stores no cells
+        """
+        return Cell_View(self)
+
+    def cells(self) -> Set[Tuple[int, ...]]:
+        """
+        :return: Set of all occupied cells, as integer tuples
+        """
+        if self._packed is None:
+            return set(product(*(range(o, e) for o, e in zip(self._origin, self._end))))
+        occupied = np.argwhere(self.get_mask()) + np.array(self._origin)
+        return set(map(tuple, occupied.tolist()))
+
+    def __contains__(self, cell):
+        return self.contains(cell)
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return "Footprint: O{}, S{}{}".format(self._origin, self._shape, "" if self.is_solid() else ", masked")
+
+
+def _bit_of(cell: Iterable[int]) -> int:
+    """
+    Bit of a cell within its chunk, every axis relative to the chunk. The last axis varies fastest
+    """
+    bit = 0
+    for c in cell:
+        bit = (bit << CHUNK_BITS) | c
+    return bit
+
+
+def _cell_of(bit: int, dimensions: int) -> Tuple[int, ...]:
+    """
+    Cell of a bit within its chunk, relative to the chunk. The inverse of _bit_of
+    """
+    return tuple((bit >> (axis * CHUNK_BITS)) & CHUNK_MASK for axis in reversed(range(dimensions)))
+
+
+def _repeat(count: int, stride: int) -> int:
+    # count ones, stride bits apart, a geometric series
+    return ((1 << (count * stride)) - 1) // ((1 << stride) - 1)
+
+
+def _box_bits(low, high) -> int:
+    """
+    Bits of the cells of a box within a chunk, 2D or 3D
+    :param low: lowest cell in the box, relative to the chunk
+    :param high: first cell past the box, relative to the chunk
+    """
+    # a row along the last axis, repeated along every other axis, from the fastest to the slowest
+    bits = 1
+    stride = 1
+    for axis in reversed(range(len(low))):
+        bits = (bits * _repeat(high[axis] - low[axis], stride)) << (low[axis] * stride)
+        stride <<= CHUNK_BITS
+    return bits
+
+
+class Voxel_Grid():
+    """
+    Persistent occupancy grid of 3D cells. The grid is split into cubic chunks of CHUNK_SIZE cells, each kept as the
+    bits of a single integer, in a persistent map. Adding a footprint builds a new grid that shares every untouched
+    chunk with the old one (copy on write), so tower states can each hold their own grid cheaply.
+    Testing a footprint against the grid is a bitwise AND per chunk it touches.
+    """
+    __slots__ = ('_chunks',)
+
+    def __init__(self, chunks: PMap = EMPTY_PMAP):
+        self._chunks = chunks
+
+    def add(self, footprint: Footprint) -> 'Voxel_Grid':
+        """
+        :return: A grid with the cells of the given 3D footprint occupied
+        """
+        chunks = self._chunks
+        for chunk, bits in footprint.chunks():
+            chunks = chunks.set(chunk, chunks.get(chunk, 0) | bits)
+        return Voxel_Grid(chunks)
+
+    def intersects(self, footprint: Footprint) -> bool:
+        """
+        Returns true if at least one cell of the given 3D footprint is occupied
+        """
+        chunks = self._chunks
+        for chunk, bits in footprint.chunks():
+            if chunks.get(chunk, 0) & bits:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(bin(bits).count('1') for bits in self._chunks.values())
+
+    def __repr__(self):
+        return "Voxel Grid: {} chunks".format(len(self._chunks))
+
+
+class Cell_Tiles(AbstractSet):
+    """
+    Persistent set of 2D cells, the flat counterpart of Voxel_Grid. The plane is split into square chunks (tiles) of
+    CHUNK_SIZE cells, each kept as the bits of a single integer, in a persistent map. Adding a footprint only touches
+    the tiles under it and shares every other tile with the old set (copy on write), so a set covering a large area is
+    cheap to grow one block at a time.
+    """
+    __slots__ = ('_tiles',)
+
+    def __init__(self, tiles: PMap = EMPTY_PMAP):
+        self._tiles = tiles
+
+    def add(self, footprint: Footprint) -> 'Cell_Tiles':
+        """
+        :return: A set holding the cells of this set and of the given 2D footprint
+        """
+        tiles = self._tiles
+        for tile, bits in footprint.chunks():
+            tiles = tiles.set(tile, tiles.get(tile, 0) | bits)
+        return Cell_Tiles(tiles)
+
+    def union(self, other: 'Cell_Tiles') -> 'Cell_Tiles':
+        """
+        :return: A set holding the cells of both sets. Costs the number of tiles of the smaller set
+        """
+        small, large = sorted((self._tiles, other._tiles), key=len)
+        tiles = large
+        for tile, bits in small.items():
+            tiles = tiles.set(tile, tiles.get(tile, 0) | bits)
+        return Cell_Tiles(tiles)
+
+    def intersection_size(self, other: 'Cell_Tiles') -> int:
+        """
+        :return: Number of cells in both sets
+        """
+        small, large = sorted((self._tiles, other._tiles), key=len)
+        return sum(bin(bits & large.get(tile, 0)).count('1') for tile, bits in small.items())
+
+    def __contains__(self, cell):
+        bits = self._tiles.get((cell[X] >> CHUNK_BITS, cell[Y] >> CHUNK_BITS), 0)
+        return (bits >> _bit_of((cell[X] & CHUNK_MASK, cell[Y] & CHUNK_MASK))) & 1 == 1
+
+    def __iter__(self):
+        for (tile_x, tile_y), bits in self._tiles.items():
+            while bits:
+                lowest = bits & -bits
+                x, y = _cell_of(lowest.bit_length() - 1, 2)
+                yield ((tile_x << CHUNK_BITS) + x, (tile_y << CHUNK_BITS) + y)
+                bits ^= lowest
+
+    def __len__(self):
+        return sum(bin(bits).count('1') for bits in self._tiles.values())
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __repr__(self):
+        return "Cell Tiles: {} tiles".format(len(self._tiles))
+
+
+class Cell_View(AbstractSet):
+    """
+    Read only set of the cells of a footprint. Membership and size are answered from the footprint's bounds (and
+    mask), so large objects such as floors never store their cells. Set operations with other sets build plain sets.
+    """
+    def __init__(self, footprint: Footprint):
+        self._footprint = footprint
+
+    def __contains__(self, cell):
+        return self._footprint.contains(cell)
+
+    def __iter__(self):
+        return self._footprint.gen_cells()
+
+    def __len__(self):
+        return len(self._footprint)
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __repr__(self):
+        return "Cell View: {}".format(self._footprint)
+
+
+class Cell_Mask(AbstractSet):
+    """
+    Set of 2D cells, kept as the bits of a single integer over a bounding box. Bit (x - x0) * width + (y - y0) stands
+    for cell (x, y). Meant for small regions that are queried often, such as the spread between two blocks: a
+    membership test is a bounds check and a bit lookup.
+
+    A mask is filled in place while it is built (add_box, add_footprint), and is not changed once handed out: spreads
+    are shared between states. Derived masks are new masks (resize).
+    """
+    __slots__ = ('_origin', '_end', '_rows', '_width', '_bits')
+
+    def __init__(self, origin: Tuple[int, int], end: Tuple[int, int], bits: int = 0):
+        """
+        :param origin: lowest cell in the box, in every axis
+        :param end: first cell past the box, in every axis (exclusive bound)
+        :param bits: occupied cells, see class description
+        """
+        self._origin = origin
+        self._end = end
+        self._rows = end[X] - origin[X]
+        self._width = end[Y] - origin[Y]
+        self._bits = bits
+
+    @staticmethod
+    def from_cells(cells: Iterable[Tuple[int, int]]) -> 'Cell_Mask':
+        cells = [(int(x), int(y)) for x, y in cells]
+        assert cells, "Cannot build a cell mask without any cells"
+        origin = (min(x for x, _ in cells), min(y for _, y in cells))
+        end = (max(x for x, _ in cells) + 1, max(y for _, y in cells) + 1)
+        width = end[Y] - origin[Y]
+        bits = 0
+        for x, y in cells:
+            bits |= 1 << ((x - origin[X]) * width + y - origin[Y])
+        return Cell_Mask(origin, end, bits)
+
+    def add_box(self, low: Tuple[int, int], high: Tuple[int, int]):
+        """
+        Occupies every cell of a box within the mask's bounds, in place. Only for masks still being built
+        :param low: lowest cell in the box
+        :param high: first cell past the box, in every axis
+        """
+        rows = high[X] - low[X]
+        row = ((1 << (high[Y] - low[Y])) - 1) << (low[Y] - self._origin[Y])
+        # Repeat the row once every width bits, a geometric series
+        repeat = ((1 << (rows * self._width)) - 1) // ((1 << self._width) - 1)
+        self._bits |= (row * repeat) << ((low[X] - self._origin[X]) * self._width)
+
+    def add_footprint(self, footprint: Footprint):
+        """
+        Occupies every cell of a 2D footprint within the mask's bounds, in place. Only for masks still being built
+        """
+        if footprint.is_solid():
+            self.add_box(footprint.get_origin(), footprint.get_end())
+            return
+        for x, y in footprint.gen_cells():
+            self._bits |= 1 << ((x - self._origin[X]) * self._width + y - self._origin[Y])
+
+    def resize(self, origin: Tuple[int, int], end: Tuple[int, int]) -> 'Cell_Mask':
+        """
+        :return: A new mask holding the cells of this mask, over the given bounds. The bounds must hold every cell
+        """
+        assert origin[X] <= self._origin[X] and origin[Y] <= self._origin[Y] and \
+               end[X] >= self._end[X] and end[Y] >= self._end[Y], "Cells would fall outside the mask"
+        mask = Cell_Mask(origin, end)
+        row_mask = (1 << self._width) - 1
+        shift = self._origin[Y] - origin[Y]
+        for x in range(self._rows):
+            row = (self._bits >> (x * self._width)) & row_mask
+            if row:
+                mask._bits |= (row << shift) << ((x + self._origin[X] - origin[X]) * mask._width)
+        return mask
+
+    def get_bits(self) -> int:
+        return self._bits
+
+    def get_origin(self) -> Tuple[int, int]:
+        return self._origin
+
+    def get_end(self) -> Tuple[int, int]:
+        return self._end
+
+    def __contains__(self, cell):
+        x = cell[X] - self._origin[X]
+        y = cell[Y] - self._origin[Y]
+        if 0 <= x < self._rows and 0 <= y < self._width:
+            return (self._bits >> (x * self._width + y)) & 1 == 1
+        return False
+
+    def __iter__(self):
+        bits = self._bits
+        while bits:
+            lowest = bits & -bits
+            x, y = divmod(lowest.bit_length() - 1, self._width)
+            yield (x + self._origin[X], y + self._origin[Y])
+            bits ^= lowest
+
+    def __len__(self):
+        return bin(self._bits).count('1')
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __repr__(self):
+        return "Cell Mask: O{}, E{}, {} cells".format(self._origin, self._end, len(self))
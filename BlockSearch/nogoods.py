@@ -0,0 +1,82 @@
+"""
+A search wide memory of failed placements (nogoods).
+
+A tower state remembers its own bad blocks, which only its descendants see. Placements that fail for reasons local to
+a block (its neighbors) fail just the same in sibling states. The nogood store is shared by every state of a search,
+so such a failure is found once.
+
+Keys are 64 bit hashes of a placement and its local context (see Tower_State.gen_nogood_key). Most lookups are of
+placements never seen before, and these are answered by a Bloom filter without touching the stored keys.
+"""
+
+from typing import Optional, Set
+
+BLOOM_BITS_PER_KEY = 10
+BLOOM_NUM_OF_HASHES = 7
+
+
+class Nogood_Store():
+    """
+    Bounded set of nogood keys. Keys are kept in two generations: once the current generation holds capacity keys, it
+    becomes the previous one and the older generation is forgotten. The store therefore holds between capacity and
+    twice capacity keys, and recently added keys are always remembered.
+    """
+    __slots__ = ('_capacity', '_current', '_previous', '_bloom', '_bloom_size', 'hits')
+
+    def __init__(self, capacity: int):
+        """
+        :param capacity: number of keys in a generation
+        """
+        self._capacity = capacity
+        self._current: Set[int] = set()
+        self._previous: Set[int] = set()
+        # The filter holds the keys of both generations. Allocated on the first add, most stores stay empty
+        self._bloom_size = 2 * capacity * BLOOM_BITS_PER_KEY
+        self._bloom: Optional[bytearray] = None
+        #  Number of lookups that found a nogood, work saved for the search
+        self.hits = 0
+
+    def _gen_bits(self, key: int):
+        # Double hashing, the two halves of a well mixed key stand for two independent hashes
+        step = (key >> 32) | 1
+        position = key & 0xffffffff
+        for _ in range(BLOOM_NUM_OF_HASHES):
+            yield position % self._bloom_size
+            position += step
+
+    def _set_bits(self, key: int):
+        bloom = self._bloom
+        for bit in self._gen_bits(key):
+            bloom[bit >> 3] |= 1 << (bit & 7)
+
+    def add(self, key: int):
+        if key in self._current:
+            return
+        if self._bloom is None:
+            self._bloom = bytearray((self._bloom_size >> 3) + 1)
+        if len(self._current) >= self._capacity:
+            self._previous = self._current
+            self._current = set()
+            self._bloom = bytearray(len(self._bloom))
+            for old_key in self._previous:
+                self._set_bits(old_key)
+        self._current.add(key)
+        self._set_bits(key)
+
+    def __contains__(self, key: int):
+        bloom = self._bloom
+        if bloom is None:
+            return False
+        for bit in self._gen_bits(key):
+            if not bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        if key in self._current or key in self._previous:
+            self.hits += 1
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def __repr__(self):
+        return "Nogood Store: {} keys, {} hits".format(len(self), self.hits)
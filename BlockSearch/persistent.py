@@ -0,0 +1,299 @@
+"""
+Persistent (immutable, structure sharing) maps and sets.
+
+Every update returns a new collection and leaves the original untouched. The new collection shares all but
+O(log n) of its nodes with the original, so keeping many versions alive (a search tree of tower states) is cheap,
+and lookups never depend on how many versions came before.
+
+Maps are hash array mapped tries: a 32 way trie over the bits of each key's hash. Each node only stores the
+branches in use, found through a bitmap:
+
+            bitmap  0b...0100101        entries (branch 0, branch 2, branch 5)
+                            |  | |
+                 branch 5 --+  | +-- branch 0
+                               +---- branch 2
+"""
+
+from collections.abc import Mapping, Set as AbstractSet
+from typing import Any, Iterable, Iterator, Optional, Tuple
+
+BITS_PER_LEVEL  = 5
+BRANCH_MASK     = (1 << BITS_PER_LEVEL) - 1
+HASH_BITS       = 64
+HASH_MASK       = (1 << HASH_BITS) - 1
+
+
+def _hash(key) -> int:
+    """
+    Mixes a key's hash, so keys which only differ in their high bits (such as packed block keys) still spread
+    over all branches of the trie.
+    """
+    h = hash(key) & HASH_MASK
+    h ^= h >> 33
+    h = (h * 0xff51afd7ed558ccd) & HASH_MASK
+    h ^= h >> 33
+    return h
+
+
+def _bit_index(bitmap: int, bit: int) -> int:
+    # Position of a branch among the branches in use
+    return bin(bitmap & (bit - 1)).count('1')
+
+
+class _Leaf():
+    # Hashes are not kept, they are only needed again when two keys share a branch (see _merge)
+    __slots__ = ('key', 'value')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
+class _Collision_Node():
+    """
+    All the leaves whose keys share the exact same hash
+    """
+    __slots__ = ('hash', 'leaves')
+
+    def __init__(self, h: int, leaves: Tuple[_Leaf, ...]):
+        self.hash = h
+        self.leaves = leaves
+
+    def find(self, shift: int, h: int, key, default):
+        if h == self.hash:
+            for leaf in self.leaves:
+                if leaf.key is key or leaf.key == key:
+                    return leaf.value
+        return default
+
+    def assoc(self, shift: int, h: int, key, value) -> Tuple[Any, bool]:
+        if h != self.hash:
+            return _merge(shift, self, self.hash, _Leaf(key, value), h), True
+        for i, leaf in enumerate(self.leaves):
+            if leaf.key is key or leaf.key == key:
+                if leaf.value is value:
+                    return self, False
+                return _Collision_Node(h, self.leaves[:i] + (_Leaf(key, value),) + self.leaves[i + 1:]), False
+        return _Collision_Node(h, self.leaves + (_Leaf(key, value),)), True
+
+    def without(self, shift: int, h: int, key):
+        if h != self.hash:
+            return self
+        for i, leaf in enumerate(self.leaves):
+            if leaf.key is key or leaf.key == key:
+                leaves = self.leaves[:i] + self.leaves[i + 1:]
+                # A single leaf left is pulled up into its parent
+                return leaves[0] if len(leaves) == 1 else _Collision_Node(h, leaves)
+        return self
+
+    def gen_leaves(self) -> Iterator[_Leaf]:
+        return iter(self.leaves)
+
+
+class _Bitmap_Node():
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap: int, entries: tuple):
+        self.bitmap = bitmap
+        self.entries = entries
+
+    def find(self, shift: int, h: int, key, default):
+        bit = 1 << ((h >> shift) & BRANCH_MASK)
+        if not self.bitmap & bit:
+            return default
+        entry = self.entries[_bit_index(self.bitmap, bit)]
+        if type(entry) is _Leaf:
+            if entry.key is key or entry.key == key:
+                return entry.value
+            return default
+        return entry.find(shift + BITS_PER_LEVEL, h, key, default)
+
+    def assoc(self, shift: int, h: int, key, value) -> Tuple['_Bitmap_Node', bool]:
+        """
+        :return: (node holding the new value, True iff the key was not in this node before)
+        """
+        bit = 1 << ((h >> shift) & BRANCH_MASK)
+        index = _bit_index(self.bitmap, bit)
+        entries = self.entries
+        if not self.bitmap & bit:
+            return _Bitmap_Node(self.bitmap | bit, entries[:index] + (_Leaf(key, value),) + entries[index:]), True
+        entry = entries[index]
+        if type(entry) is _Leaf:
+            if entry.key is key or entry.key == key:
+                if entry.value is value:
+                    return self, False
+                new_entry, added = _Leaf(key, value), False
+            else:
+                new_entry, added = _merge(shift + BITS_PER_LEVEL, entry, _hash(entry.key), _Leaf(key, value), h), True
+        else:
+            new_entry, added = entry.assoc(shift + BITS_PER_LEVEL, h, key, value)
+            if new_entry is entry:
+                return self, added
+        return _Bitmap_Node(self.bitmap, entries[:index] + (new_entry,) + entries[index + 1:]), added
+
+    def without(self, shift: int, h: int, key):
+        """
+        :return: node without the key, a single leaf if only one is left, or None if nothing is left
+        """
+        bit = 1 << ((h >> shift) & BRANCH_MASK)
+        if not self.bitmap & bit:
+            return self
+        index = _bit_index(self.bitmap, bit)
+        entries = self.entries
+        entry = entries[index]
+        if type(entry) is _Leaf:
+            if not (entry.key is key or entry.key == key):
+                return self
+            new_entry = None
+        else:
+            new_entry = entry.without(shift + BITS_PER_LEVEL, h, key)
+            if new_entry is entry:
+                return self
+        if new_entry is None:
+            if len(entries) == 1:
+                return None
+            entries = entries[:index] + entries[index + 1:]
+            if len(entries) == 1 and type(entries[0]) is _Leaf and shift:
+                return entries[0]
+            return _Bitmap_Node(self.bitmap ^ bit, entries)
+        if len(entries) == 1 and type(new_entry) is _Leaf and shift:
+            return new_entry
+        return _Bitmap_Node(self.bitmap, entries[:index] + (new_entry,) + entries[index + 1:])
+
+    def gen_leaves(self) -> Iterator[_Leaf]:
+        for entry in self.entries:
+            if type(entry) is _Leaf:
+                yield entry
+            else:
+                yield from entry.gen_leaves()
+
+
+def _merge(shift: int, entry1, hash1: int, entry2, hash2: int):
+    """
+    Smallest sub trie holding two entries (leaves or collision nodes) with different keys
+    :param hash1: hash of entry1's keys
+    :param hash2: hash of entry2's keys
+    """
+    if hash1 == hash2:
+        leaves1 = (entry1,) if type(entry1) is _Leaf else entry1.leaves
+        leaves2 = (entry2,) if type(entry2) is _Leaf else entry2.leaves
+        return _Collision_Node(hash1, leaves1 + leaves2)
+    branch1 = (hash1 >> shift) & BRANCH_MASK
+    branch2 = (hash2 >> shift) & BRANCH_MASK
+    if branch1 == branch2:
+        return _Bitmap_Node(1 << branch1, (_merge(shift + BITS_PER_LEVEL, entry1, hash1, entry2, hash2),))
+    entries = (entry1, entry2) if branch1 < branch2 else (entry2, entry1)
+    return _Bitmap_Node((1 << branch1) | (1 << branch2), entries)
+
+
+_EMPTY_NODE = _Bitmap_Node(0, ())
+_MISSING = object()
+
+
+class PMap(Mapping):
+    """
+    Persistent hash map. set and remove return a new map, see module description.
+    """
+    __slots__ = ('_root', '_size')
+
+    def __init__(self, items: Iterable[Tuple[Any, Any]] = (), _root: _Bitmap_Node = _EMPTY_NODE, _size: int = 0):
+        self._root = _root
+        self._size = _size
+        for key, value in items:
+            self._root, added = self._root.assoc(0, _hash(key), key, value)
+            self._size += added
+
+    def get(self, key, default=None):
+        return self._root.find(0, _hash(key), key, default)
+
+    def __getitem__(self, key):
+        value = self._root.find(0, _hash(key), key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._root.find(0, _hash(key), key, _MISSING) is not _MISSING
+
+    def set(self, key, value) -> 'PMap':
+        """
+        :return: A map with key set to value
+        """
+        root, added = self._root.assoc(0, _hash(key), key, value)
+        if root is self._root:
+            return self
+        return PMap(_root=root, _size=self._size + added)
+
+    def remove(self, key) -> 'PMap':
+        """
+        :return: A map without key, raises KeyError if the key is missing
+        """
+        root = self._root.without(0, _hash(key), key)
+        if root is self._root:
+            raise KeyError(key)
+        return PMap(_root=root if root is not None else _EMPTY_NODE, _size=self._size - 1)
+
+    def discard(self, key) -> 'PMap':
+        """
+        :return: A map without key
+        """
+        return self.remove(key) if key in self else self
+
+    def items(self) -> Iterator[Tuple[Any, Any]]:
+        return ((leaf.key, leaf.value) for leaf in self._root.gen_leaves())
+
+    def values(self) -> Iterator[Any]:
+        return (leaf.value for leaf in self._root.gen_leaves())
+
+    def __iter__(self):
+        return (leaf.key for leaf in self._root.gen_leaves())
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return "PMap({})".format(dict(self.items()))
+
+
+class PSet(AbstractSet):
+    """
+    Persistent set. add and remove return a new set, see module description.
+    Set operations with other sets (&, |, -) build plain sets.
+    """
+    __slots__ = ('_map',)
+
+    def __init__(self, items: Iterable = (), _map: Optional[PMap] = None):
+        self._map = _map if _map is not None else PMap((item, True) for item in items)
+
+    def add(self, item) -> 'PSet':
+        new_map = self._map.set(item, True)
+        return self if new_map is self._map else PSet(_map=new_map)
+
+    def remove(self, item) -> 'PSet':
+        """
+        :return: A set without item, raises KeyError if the item is missing
+        """
+        return PSet(_map=self._map.remove(item))
+
+    def discard(self, item) -> 'PSet':
+        return self.remove(item) if item in self else self
+
+    def __contains__(self, item):
+        return item in self._map
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __len__(self):
+        return len(self._map)
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __repr__(self):
+        return "PSet({})".format(set(self))
+
+
+EMPTY_PMAP = PMap()
+EMPTY_PSET = PSet()
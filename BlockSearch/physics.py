@@ -5,6 +5,7 @@ from memoized import memoized
 from stl import mesh
 
 from BlockSearch.block          import Block
+from BlockSearch.footprint      import Cell_Mask
 from typing                     import List, Set, Dict, Tuple, Optional
 from BlockSearch.render         import display_board
 
@@ -34,18 +35,20 @@ def is_stable(tower_state, new_block : Block):
 
     # Initiate the relation to surrounding blocks in the tower
     # Short-circuit the expensive calculation if can be skipped.
-    blocks_below = calculate_below(new_block, tower_state.get_by_top(bottom_level - 1)) \
+    # Only blocks sharing spatial buckets with the new block's cover are considered, see Tower_State.get_by_top_near
+    cover = new_block.get_cover()
+    blocks_below = calculate_below(new_block, tower_state.get_by_top_near(bottom_level - 1, cover)) \
         if (bottom_level - 1) in tower_state \
         else set()
     tower_state.set_blocks_below(new_block, blocks_below)
 
-    blocks_above = calculate_above(new_block, tower_state.get_by_bottom(top_level + 1)) \
+    blocks_above = calculate_above(new_block, tower_state.get_by_bottom_near(top_level + 1, cover)) \
         if (top_level + 1) in tower_state \
         else set()
     tower_state.set_blocks_above(new_block, blocks_above)
 
-    # Last attempt to find if this situation was already stored as a unstable combination
-    if tower_state.is_bad_block(tower_state.stringify_block_neighbors(new_block)):
+    # Last attempt to find if this situation was already stored as a unstable combination, by any state of the search
+    if tower_state.is_bad_block_state(new_block):
         return False
 
     # connect the new block to the blocks above and below by making changes to their neighbor setting.
@@ -54,7 +57,7 @@ def is_stable(tower_state, new_block : Block):
     if is_stable_helper((tower_state, new_block)):
         return True
     else:
-        # We can stringify this block's failure, contingent on it's neighbors.
+        # We can key this block's failure, contingent on it's neighbors.
         # This will allow to quickly check in the future if this block is stable, relative to its surroundings
         tower_state.add_bad_block_state(new_block)
 
@@ -74,8 +77,8 @@ def is_stable_helper(arg):
         return True
 
     # Initiate the support block list. Assumed to exist
-    blocks_below: Set[Block] = tower_state.get_blocks_below(new_block)
-    blocks_above: Set[Block] = tower_state.get_blocks_above(new_block)
+    blocks_below: Tuple[Block, ...] = tower_state.get_blocks_below(new_block)
+    blocks_above: Tuple[Block, ...] = tower_state.get_blocks_above(new_block)
 
     # Empty set means block is floating in air. This is considered a bug in case new blocks
     # are only spawned off others
@@ -85,25 +88,24 @@ def is_stable_helper(arg):
         # The aggregate center of gravity will take into consideration any support from above
         center_x, center_y, center_z = new_block.get_aggregate_cog(tower_state)
 
+        # COG's can have floating point values not alligned with the grid, we therefore check the four cells
+        # borders.
+        COG_candidates = [(math.floor(center_x), math.floor(center_y)),
+                          (math.floor(center_x), math.ceil(center_y)),
+                          (math.ceil(center_x), math.floor(center_y)),
+                          (math.ceil(center_x), math.ceil(center_y))]
+
         # We iterate twice over to compare within every two combinations of blocks, without order being important
         for i, block1 in enumerate(blocks_below):
-            for block2 in list(blocks_below)[i:]:
+            for block2 in blocks_below[i:]:
 
                 # If the center of gravity falls above a theoretically supported cell of two support blocks,
                 # then *all* these blocks support the new block, and we must recalculate each center of gravity for
                 # further recursive stability calculations.
 
-                # COG's can have floating point values not alligned with the grid, we therefore check the four cells
-                # borders.
-                COG_candidates = [(math.floor(center_x), math.floor(center_y)),
-                                  (math.floor(center_x), math.ceil(center_y)),
-                                  (math.ceil(center_x), math.floor(center_y)),
-                                  (math.ceil(center_x), math.ceil(center_y))]
-
-                # At least one pair of support blocks is enough
-                supported = False
-                for cog in COG_candidates:
-                    supported |= cog in tower_state.get_spread(block1, block2)
+                # At least one pair of support blocks is enough. Spreads are bitmasks, each candidate is a lookup.
+                spread = tower_state.get_spread(block1, block2)
+                supported = any(cog in spread for cog in COG_candidates)
 
                 if supported:
 
@@ -120,6 +122,99 @@ def is_stable_helper(arg):
 
     return False
 
+def get_aggregate_mass(tower_state, block: Block,
+                       aggregates: Optional[Dict[Block, Tuple[float, np.ndarray]]] = None) -> Tuple[float, np.ndarray]:
+    """
+    Mass and first moment of mass of a block and all the blocks above it, same as Block.get_aggregate_mass, but read
+    from the given state only: blocks are shared between sibling states, so nothing is cached on them.
+    :param tower_state: A state of the block tower, with the block connected to its neighbors
+    :param block: a block of the tower
+    :param aggregates: block -> (mass, moment) of the blocks already measured in this state, filled while measuring
+    :return: (mass, moment)
+    """
+    if aggregates is None:
+        aggregates = dict()
+    # Blocks above first, without recursion, towers can be taller than the recursion limit
+    stack = [block]
+    while stack:
+        top = stack[-1]
+        if top in aggregates:
+            stack.pop()
+            continue
+        blocks_above = tower_state.get_blocks_above(top)
+        missing = [block_above for block_above in blocks_above if block_above not in aggregates]
+        if missing:
+            stack.extend(missing)
+            continue
+        mass = top.get_mass()
+        moment = mass * top.get_cog()
+        for block_above in blocks_above:
+            above_mass, above_moment = aggregates[block_above]
+            mass += above_mass
+            moment = moment + above_moment
+        aggregates[top] = (mass, moment)
+        stack.pop()
+    return aggregates[block]
+
+def get_stability_margin(tower_state, block: Block,
+                         aggregates: Optional[Dict[Block, Tuple[float, np.ndarray]]] = None) -> float:
+    """
+    How far a block is from toppling: the distance from its aggregate center of gravity to the nearest cell outside
+    its support, the spreads of all pairs of blocks below it (see is_stable_helper). Distances are along the grid
+    axes (the larger of the X and Y distances), so a margin of 0 means the center of gravity sits on an unsupported
+    cell.
+
+                    Top View
+                    ---------------------
+                      S S S S S
+                      S S S S S     <- the margin of a center of gravity at C is 2, the cells of the third
+                      S S C S S        column to its right are not supported
+                      S S S S S
+
+    :param tower_state: A state of the block tower, with the block connected to its neighbors
+    :param block: a block of the tower
+    :param aggregates: aggregate masses already measured in this state, see get_aggregate_mass
+    :return: The margin in cells, infinite for a block standing on the floor
+    """
+    if block.get_bottom_level() == FLOOR_LEVEL:
+        return math.inf
+    blocks_below = tower_state.get_blocks_below(block)
+    if not blocks_below:
+        return 0.0
+
+    # The spread of a block with itself is its cover, the spreads of other pairs are masks. All are ORed into a single
+    # mask over their common bounds
+    covers = [block_below.get_cover() for block_below in blocks_below]
+    spreads = [tower_state.get_spread(block1, block2)
+               for i, block1 in enumerate(blocks_below) for block2 in blocks_below[i + 1:]]
+    boxes = covers + spreads
+    origin = (min(box.get_origin()[X] for box in boxes), min(box.get_origin()[Y] for box in boxes))
+    end = (max(box.get_end()[X] for box in boxes), max(box.get_end()[Y] for box in boxes))
+    support = Cell_Mask(origin, end)
+    for cover in covers:
+        support.add_footprint(cover)
+    bits = support.get_bits()
+    for spread in spreads:
+        bits |= spread.resize(origin, end).get_bits()
+    support = Cell_Mask(origin, end, bits)
+
+    mass, moment = get_aggregate_mass(tower_state, block, aggregates)
+    center_x, center_y, _ = moment / mass
+    nearest_x, nearest_y = int(round(center_x)), int(round(center_y))
+
+    # Walk square rings around the nearest cell. Cells of ring r are at least r - 0.5 away from the center of
+    # gravity, the support is finite so an unsupported cell is always found
+    margin = math.inf
+    radius = 0
+    while radius - 0.5 < margin:
+        for x in range(nearest_x - radius, nearest_x + radius + 1):
+            step = 1 if x in (nearest_x - radius, nearest_x + radius) else 2 * radius
+            for y in range(nearest_y - radius, nearest_y + radius + 1, max(step, 1)):
+                if (x, y) not in support:
+                    margin = min(margin, max(abs(x - center_x), abs(y - center_y)))
+        radius += 1
+    return float(margin)
+
 def calculate_below(block : Block, blocks : List[Block]) -> Set[Block]:
     """
     Calculated which of a given list of blocks are strictly under this given sample block.
@@ -144,13 +239,11 @@ def calculate_below(block : Block, blocks : List[Block]) -> Set[Block]:
     """
     supports = set()
 
-    cells = block.get_cover_cells()
+    cover = block.get_cover()
     for potential_support in blocks:
-        for cell in cells:
-            # Check if this cell is above under a cell from another block
-            if cell in potential_support.get_cover_cells():
-                supports.add(potential_support)
-                break
+        # Check if any cell is above a cell from another block
+        if cover.intersects(potential_support.get_cover()):
+            supports.add(potential_support)
     return supports
 
 def calculate_above(block : Block, blocks : List[Block]) -> Set[Block]:
@@ -177,13 +270,11 @@ def calculate_above(block : Block, blocks : List[Block]) -> Set[Block]:
     """
     supported = set()
 
-    cells = block.get_cover_cells()
+    cover = block.get_cover()
     for potential_supported_block in blocks:
-        for cell in cells:
-            # Check if this cell is above under a cell from another block
-            if cell in potential_supported_block.get_cover_cells():
-                supported.add(potential_supported_block)
-                break
+        # Check if any cell is under a cell from another block
+        if cover.intersects(potential_supported_block.get_cover()):
+            supported.add(potential_supported_block)
     return supported
 
 def combine(meshes):
@@ -199,35 +290,9 @@ def is_overlapping(block_tower , new_block : Block):
     if block_tower.is_bad_block(new_block):
         return True
 
-    bottom_level : int = new_block.get_bottom_level()
-    top_level    : int = new_block.get_top_level()
-    """
-    Only scan blocks with top levels above my bottom level.
-    X - Block. B - Bottom layer. T - Top layer
-    
-                        XXXXXXX          
-    new block           XXXXXXX         others  TTTTTTTT     others
-                        BBBBBBB           in    XXXXXXXX       out
-                                                                        TTTT
-                                                                        XXXX
-    
-    """
-    for level in filter(lambda l: l >= bottom_level, block_tower.keys()):
-        for other_block in block_tower.get_by_top(level):
-            """
-            Diqualify for overlap any block with a bottom above our top
-            X - Block. B - Bottom layer. T - Top layer
-
-                                            others  XXXXXXXX      others    XXXXX
-                                              in    XXXXXXXX       out      BBBBB
-                                TTTTTTT             BBBBBBBB
-            new block           XXXXXXX               
-                                XXXXXXX           
-
-
-            """
-            if other_block.get_bottom_level() <= top_level and other_block.is_overlapping(new_block):
-                # perform a memoization of bad blocks we've seen
-                block_tower.add_bad_block(new_block)
-                return True
+    # All occupied cells of the tower are kept in a voxel grid, a single masked read of the new block's cells
+    if block_tower.overlaps(new_block):
+        # perform a memoization of bad blocks we've seen
+        block_tower.add_bad_block(new_block)
+        return True
     return False
\ No newline at end of file
@@ -1,11 +1,13 @@
 from random import sample
 
-from BlockSearch.block import Block, ORIENTATIONS, ORIENTATION, Floor, RingFloor
+from BlockSearch.block import Block, ORIENTATIONS, ORIENTATION, Floor, RingFloor, Block_Pool, BLOCK_POOL, \
+    ORIENTATION_TEMPLATES, ORIENTATION_TO_INDEX, DESCRIPTOR_DTYPE, POSITION_OFFSET, CONTEXT_FLAG, MAX_NEIGHBOR_COUNT
 from unittest import TestCase
 from stl import mesh
 from BlockSearch.render import *
 from matplotlib.colors import to_rgba
 import time
+import tracemalloc
 # from BlockSearch.tower_state import Tower_State
 from pprint import pprint as pp
 
@@ -175,6 +177,51 @@ class Block_Test(TestCase):
                 for block2 in blocks_2:
                     self.assertEqual(hash(block1), hash(block2))
 
+    def test_key(self):
+        for orientation in ORIENTATIONS.values():
+            for position in [(0, 0, 0), (-15, 7, 1), (30, -30, 200)]:
+                key = Block.gen_key((orientation, position))
+                self.assertEqual(Block.parse_key(key), (orientation, position))
+                self.assertEqual(Block(block_mesh, orientation, position).get_key(), key)
+
+        block1 = Block(block_mesh, (0, 0, 0), (0, 0, 1))
+        block2 = Block(block_mesh, (0, 0, 0), (0, 0, 2))
+        self.assertTrue(block1 < block2)
+        self.assertNotEqual(block1, block2)
+
+        # context keys never collide with plain keys, even without any neighbors
+        context_key = Block.gen_context_key(block1.get_key(), 0, 0)
+        self.assertNotEqual(context_key, block1.get_key())
+        self.assertNotEqual(context_key, Block.gen_context_key(block1.get_key(), 1, 0))
+        self.assertNotEqual(Block.gen_context_key(block1.get_key(), 1, 0),
+                            Block.gen_context_key(block1.get_key(), 0, 1))
+        # neighbor counts saturate
+        self.assertEqual(Block.gen_context_key(block1.get_key(), 100, 100),
+                         Block.gen_context_key(block1.get_key(), MAX_NEIGHBOR_COUNT, MAX_NEIGHBOR_COUNT))
+
+        self.assertNotEqual(Floor(floor_mesh), Block(block_mesh, (0, 0, 0), (0, 0, 0)))
+
+    def test_key_range(self):
+        low, high = -POSITION_OFFSET, POSITION_OFFSET - 1
+        positions = [(x, y, z) for x in (low, -32769, 0, 32768, high) for y in (low, 0, high) for z in (low, 0, high)]
+        descriptors = [(orientation, position) for orientation in ORIENTATIONS.values() for position in positions]
+        keys = [Block.gen_key(descriptor) for descriptor in descriptors]
+        # positions past 16 bits never spill into the orientation or another axis
+        self.assertEqual(len(set(keys)), len(descriptors))
+        for descriptor, key in zip(descriptors, keys):
+            self.assertEqual(Block.parse_key(key), descriptor)
+            self.assertLess(key, 2 ** 64)
+            self.assertNotEqual(key & CONTEXT_FLAG, CONTEXT_FLAG)
+
+        array = np.array([(ORIENTATION_TO_INDEX[orientation], *position) for orientation, position in descriptors],
+                         dtype=DESCRIPTOR_DTYPE)
+        self.assertEqual(Block.gen_keys(array).tolist(), keys)
+
+        for position in [(high + 1, 0, 0), (0, low - 1, 0), (0, 0, high + 1)]:
+            self.assertRaises(AssertionError, Block.gen_key, (ORIENTATIONS['flat_wide'], position))
+            self.assertRaises(AssertionError, Block.gen_keys,
+                              np.array([(0, *position)], dtype=DESCRIPTOR_DTYPE))
+
     def test_next_block(self):
         # # simple
         block1 = Block(block_mesh, (0, 0, 0), (0, 0, 0))
@@ -255,6 +302,35 @@ class Block_Test(TestCase):
         print("Time to spawn {} descriptors: {}".format(num_of_desc, ee))
         pp(result)
 
+    def test_son_desc_batch(self):
+        blocks = [Block(block_mesh, orientation, (i, 2 * i, 0)) for i, orientation in enumerate(ORIENTATIONS)]
+        blocks.append(RingFloor(floor_mesh, 30, 3, 2, 6))
+        expected = set()
+        for block in blocks:
+            expected.update(block.gen_possible_block_descriptors())
+
+        s = time.time()
+        batch = Block.gen_descriptor_batch(blocks)
+        elapse = time.time() - s
+        descriptors = Block.to_descriptors(batch)
+        self.assertEqual(len(descriptors), len(expected))
+        self.assertEqual(set(descriptors), expected)
+        self.assertEqual(list(Block.gen_keys(batch)), [Block.gen_key(desc) for desc in descriptors])
+        print("Time to spawn {} descriptors in a batch: {}".format(len(descriptors), elapse))
+
+        random_batch = Block.gen_descriptor_batch(blocks, random_order=True)
+        self.assertEqual(set(Block.to_descriptors(random_batch)), expected)
+
+    def test_son_desc_limit(self):
+        block = Block(block_mesh, 'flat_wide', (0, 0, 1))
+        all_sons = list(block.gen_possible_block_descriptors())
+        self.assertGreater(len(all_sons), 3)
+        self.assertEqual(list(block.gen_possible_block_descriptors(limit_len=3)), all_sons[:3])
+        # fractional limits round up, and no limit is below a single son
+        self.assertEqual(len(list(block.gen_possible_block_descriptors(limit_len=2.5))), 3)
+        self.assertEqual(len(list(block.gen_possible_block_descriptors(limit_len=0))), 1)
+        self.assertEqual(len(block.gen_descriptor_array(limit_len=0.5)), 1)
+
     def test_spawn_block_time(self):
         size = 10
         all_desc = []
@@ -269,6 +345,57 @@ class Block_Test(TestCase):
         ee = time.time() - ss
         print("Time to spawn {} Blocks: {}".format(len(all_desc), ee))
 
+    def test_orientation_templates(self):
+        for orientation in ORIENTATIONS.values():
+            template = ORIENTATION_TEMPLATES[orientation]
+            self.assertEqual(len(template.cell_offsets), 45)
+            block = Block(block_mesh, orientation, (5, -3, 8))
+            self.assertEqual(block.get_cells(), block.get_footprint().cells())
+            self.assertEqual(block.get_cover_cells(), block.get_cover().cells())
+            self.assertEqual(block.get_bottom_level(), 8 + template.bottom_offset)
+            self.assertEqual(block.get_top_level(), 8 + template.top_offset)
+
+    def test_block_memory(self):
+        size = 10000
+        descriptors = [('flat_wide', (i % 100, i // 100, 1)) for i in range(size)]
+        # Warm up the block pool, so only the blocks themselves are measured
+        pooled = [Block(block_mesh, *desc) for desc in descriptors]
+
+        tracemalloc.start()
+        start, _ = tracemalloc.get_traced_memory()
+        blocks = [Block(block_mesh, *desc) for desc in descriptors]
+        end, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("Bytes per block: {}".format((end - start) / size))
+
+    def test_block_pool(self):
+        block1 = Block(block_mesh, 'flat_wide', (4, 4, 4))
+        hits = BLOCK_POOL.hits
+        block2 = Block(block_mesh, (0, 90, 0), (4, 4, 4))
+        self.assertTrue(block1._geometry is block2._geometry)
+        self.assertEqual(BLOCK_POOL.hits, hits + 1)
+        self.assertTrue(block1 is not block2)
+
+        pool = Block_Pool(max_size=10)
+        geometries = [pool.get((0, 0, 0), (i, 0, 0)) for i in range(20)]
+        self.assertEqual(len(pool), 10)
+        self.assertEqual(pool.misses, 20)
+        self.assertTrue(pool.get((0, 0, 0), (19, 0, 0)) is geometries[19])
+        self.assertTrue(pool.get((0, 0, 0), (0, 0, 0)) is not geometries[0])
+        self.assertEqual(pool.hits, 1)
+        print(pool)
+
+    def test_lazy_mesh(self):
+        block = Block(block_mesh, 'tall_thin', (3, -2, 8))
+        self.assertIsNone(block._meshes)
+
+        rendered = block.render()
+        self.assertTrue(rendered is block.render())
+        cells = block.get_cells()
+        for axis in (X, Y, Z):
+            self.assertAlmostEqual(rendered.min_[axis], min(c[axis] for c in cells) - 0.5)
+            self.assertAlmostEqual(rendered.max_[axis], max(c[axis] for c in cells) + 0.5)
+
     def test_inertia(self):
         block1 = Block(block_mesh, (0,0,0,), (0,0,0))
         pp(block1.render().get_mass_properties())
@@ -323,6 +450,19 @@ class Floor_Tests(TestCase):
         if DISPLAY:
             display_colored([floor.render(), block1.render()], [to_rgba((0.1, 0.1, 0.1), 0.001 ), 'b'])
 
+    def test_implicit_cells(self):
+        floor = Floor(floor_mesh, size=4)
+        self.assertEqual(set(floor.get_cover_cells()), {(x, y) for x in range(-2, 3) for y in range(-2, 3)})
+        self.assertEqual(len(floor.get_cells()), 25)
+
+        # A huge floor answers membership and support from its bounds alone
+        s = time.time()
+        floor = Floor(floor_mesh, size=100000)
+        self.assertTrue((50000, -50000) in floor.get_cover_cells())
+        self.assertFalse((50001, 0) in floor.get_cover_cells())
+        self.assertTrue(Block(block_mesh, 'flat_wide', (49999, 0, 1)).get_cover().intersects(floor.get_cover()))
+        print("Huge floor in {}".format(time.time() - s))
+
 
 class Ring_Floor_Tests(TestCase):
 
@@ -20,7 +20,7 @@ def cover_heuristic(state: Tower_State, block_search: Block_Search):
     end_goal = state._starting_cover_size / block_search._height_goal
     proportional_height = state._max_level / block_search._height_goal
     desired_cover = state._starting_cover_size / proportional_height
-    actual_cover = state.get_cover_at_level(state._max_level - 1)
+    actual_cover = state.get_cover_area_at_level(state._max_level - 1)
     if actual_cover > desired_cover:
         # encourage building tall
         return (block_search._height_goal - state._max_level)
@@ -0,0 +1,117 @@
+from unittest import TestCase
+import time
+
+import numpy as np
+
+from BlockSearch.footprint import Footprint, Cell_Mask, Cell_Tiles, Voxel_Grid
+
+
+class Footprint_Test(TestCase):
+
+    def test_solid_intersection(self):
+        footprint1 = Footprint((0, 0, 0), (1, 15, 3))
+        footprint2 = Footprint((0, 14, 2), (3, 3, 3))
+        footprint3 = Footprint((1, 0, 0), (1, 15, 3))
+
+        self.assertTrue(footprint1.intersects(footprint2))
+        self.assertEqual(footprint1.intersection_size(footprint2), 1)
+        self.assertFalse(footprint1.intersects(footprint3))
+        self.assertEqual(footprint1.intersection_size(footprint3), 0)
+        self.assertEqual(len(footprint1), 45)
+
+    def test_masked_intersection(self):
+        ring = {(x, y) for x in range(-3, 4) for y in range(-3, 4) if max(abs(x), abs(y)) == 3}
+        footprint = Footprint.from_cells(ring)
+        self.assertFalse(footprint.is_solid())
+        self.assertEqual(footprint.cells(), ring)
+        self.assertEqual(len(footprint), len(ring))
+
+        # the hole in the middle of the ring
+        self.assertFalse(footprint.intersects(Footprint((-2, -2), (5, 5))))
+        self.assertTrue(footprint.intersects(Footprint((-2, -2), (6, 5))))
+        self.assertTrue((3, 0) in footprint)
+        self.assertFalse((0, 0) in footprint)
+
+    def test_cells(self):
+        footprint = Footprint((-1, -7, 0), (3, 15, 1))
+        cells = {(x, y, 0) for x in range(-1, 2) for y in range(-7, 8)}
+        self.assertEqual(footprint.cells(), cells)
+        self.assertEqual(footprint.project().cells(), {(x, y) for x, y, _ in cells})
+
+    def test_covered_by(self):
+        footprint = Footprint((0, 0), (15, 3))
+        above = [Footprint((0, 0), (3, 3)), Footprint((2, 0), (3, 3)), Footprint((20, 0), (3, 3))]
+        self.assertEqual(footprint.covered_by(above), 15)
+
+    def test_intersection_time(self):
+        footprint1 = Footprint((0, 0, 0), (1, 15, 3))
+        footprint2 = Footprint((0, 7, 1), (15, 1, 3))
+        cells1 = footprint1.cells()
+        cells2 = footprint2.cells()
+        r = 100000
+
+        s = time.time()
+        for _ in range(r):
+            footprint1.intersects(footprint2)
+        footprint_elapse = time.time() - s
+
+        s = time.time()
+        for _ in range(r):
+            _ = (cells1 & cells2) != set()
+        set_elapse = time.time() - s
+        print("For {}X:\tfootprint {}\tsets {}".format(r, footprint_elapse, set_elapse))
+
+    def test_cell_mask(self):
+        mask = Cell_Mask((-2, -3), (4, 5))
+        mask.add_box((-2, -3), (0, 5))
+        mask.add_box((1, 0), (4, 2))
+        cells = {(x, y) for x in range(-2, 0) for y in range(-3, 5)} | {(x, y) for x in range(1, 4) for y in range(0, 2)}
+        self.assertEqual(set(mask), cells)
+        self.assertEqual(len(mask), len(cells))
+        self.assertEqual(mask, cells)
+        self.assertFalse((0, 0) in mask)
+        self.assertFalse((4, 0) in mask)
+        self.assertEqual(Cell_Mask.from_cells(cells), mask)
+
+    def test_voxel_grid(self):
+        ring = np.ones((12, 12, 1), dtype=bool)
+        ring[2:10, 2:10] = False
+        placed = [Footprint((-6, -6, 0), (12, 12, 1), ring),
+                  Footprint((-9, -1, 1), (3, 15, 1)),
+                  Footprint((5, 7, -3), (1, 3, 9))]
+        grid = Voxel_Grid()
+        for footprint in placed:
+            older_grid, grid = grid, grid.add(footprint)
+            # adding never changes the older grid
+            self.assertEqual(len(older_grid) + len(footprint), len(grid))
+
+        rng = np.random.RandomState(0)
+        for _ in range(500):
+            footprint = Footprint(rng.randint(-12, 12, 3), rng.randint(1, 10, 3))
+            self.assertEqual(grid.intersects(footprint), any(footprint.intersects(other) for other in placed),
+                             str(footprint))
+
+    def test_cell_tiles(self):
+        ring = np.ones((12, 12), dtype=bool)
+        ring[2:10, 2:10] = False
+        placed = [Footprint((-6, -6), (12, 12), ring),
+                  Footprint((-9, -1), (3, 15)),
+                  Footprint((5, 7), (1, 3))]
+        tiles = Cell_Tiles()
+        cells = set()
+        for footprint in placed:
+            older_tiles, tiles = tiles, tiles.add(footprint)
+            # adding never changes the older set
+            self.assertEqual(set(older_tiles), cells)
+            cells |= footprint.cells()
+            self.assertEqual(set(tiles), cells)
+            self.assertEqual(len(tiles), len(cells))
+        self.assertTrue((-6, -6) in tiles)
+        self.assertFalse((0, 0) in tiles)
+
+        # a small footprint only touches the tiles under it
+        self.assertEqual(len(tiles.add(Footprint((1000, 1000), (2, 2)))._tiles), len(tiles._tiles) + 1)
+
+        other = Cell_Tiles().add(Footprint((-3, -3), (6, 6)))
+        self.assertEqual(set(tiles.union(other)), cells | set(other))
+        self.assertEqual(tiles.intersection_size(other), len(cells & set(other)))
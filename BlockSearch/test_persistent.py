@@ -0,0 +1,59 @@
+from unittest import TestCase
+import random
+
+from BlockSearch.persistent import PSet, EMPTY_PMAP, EMPTY_PSET
+
+
+class Colliding_Key():
+    """
+    A key with a poor hash, so many keys share a branch or the exact same hash
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return self.value % 7
+
+    def __eq__(self, other):
+        return isinstance(other, Colliding_Key) and other.value == self.value
+
+
+class Persistent_Test(TestCase):
+
+    def test_map(self):
+        rng = random.Random(0)
+        for make_key in [lambda i: i, lambda i: i << 40, Colliding_Key]:
+            versions = [(EMPTY_PMAP, dict())]
+            for _ in range(3000):
+                pmap, expected = versions[rng.randrange(len(versions))]
+                key = make_key(rng.randrange(200))
+                expected = dict(expected)
+                if rng.random() < 0.3 and expected:
+                    key = rng.choice(list(expected))
+                    pmap = pmap.remove(key)
+                    del expected[key]
+                else:
+                    pmap = pmap.set(key, rng.random())
+                    expected[key] = pmap[key]
+                versions.append((pmap, expected))
+
+            # every version is left as it was built
+            for pmap, expected in versions:
+                self.assertEqual(len(pmap), len(expected))
+                self.assertEqual(dict(pmap.items()), expected)
+                self.assertEqual(pmap, expected)
+
+        self.assertRaises(KeyError, lambda: EMPTY_PMAP.remove(1))
+        self.assertIs(EMPTY_PMAP.discard(1), EMPTY_PMAP)
+
+    def test_set(self):
+        pset = EMPTY_PSET.add(1).add(2).add(3)
+        self.assertEqual(pset, {1, 2, 3})
+        self.assertEqual(EMPTY_PSET, set())
+        self.assertIs(pset.add(2), pset)
+        self.assertEqual(pset.remove(2), {1, 3})
+        self.assertEqual(pset, {1, 2, 3})
+        # set operations build plain sets
+        self.assertEqual(pset & {2, 3, 4}, {2, 3})
+        self.assertIsInstance(pset & {2}, set)
+        self.assertEqual(PSet(range(100)), set(range(100)))
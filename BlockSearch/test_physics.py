@@ -329,7 +329,22 @@ class Physics_Test(TestCase):
                             [matte_color] * (len(self.meshes)) + [new_color] + [emphasis_color] * len(supportees) )
 
     def test_aggregate_cog(self):
-        pass
+        tower = Tower_State()
+        for new_block in [Block(block_mesh, 'flat_wide', (0, i % 3, i)) for i in range(1, 20)]:
+            if tower.can_add(new_block):
+                tower.add(new_block)
+        blocks = list(tower.gen_blocks())
+        self.assertTrue(len(blocks) > 1)
+
+        start = time.time()
+        cogs = [b.get_aggregate_cog(tower) for b in blocks]
+        elapse = time.time() - start
+        print("Analytic aggregate COG for {} blocks: {}".format(len(blocks), elapse))
+
+        for block, cog in zip(blocks, cogs):
+            mesh_cog = combine(block.get_aggregate_data(tower)).get_mass_properties()[1]
+            for axis in (X, Y, Z):
+                self.assertAlmostEqual(cog[axis], mesh_cog[axis], places=4)
 
     def test_tower_not_stable(self):
         DISPLAY = False
@@ -429,7 +444,7 @@ class Physics_Test(TestCase):
                                                          random_order= True))
                 shuffle(possible_son_descriptors)
                 for desc in possible_son_descriptors:
-                    if not state.is_bad_block(Block.gen_str(desc)):
+                    if not state.is_bad_block(Block.gen_key(desc)):
                         orientation, position = desc
                         new_block = Block(block_mesh, orientation, position)
                         if state.can_add(new_block):
@@ -540,7 +555,7 @@ class Physics_Test(TestCase):
                                                          random_order= True))
                 shuffle(possible_son_descriptors)
                 for desc in possible_son_descriptors:
-                    if not state.is_bad_block(Block.gen_str(desc)):
+                    if not state.is_bad_block(Block.gen_key(desc)):
                         orientation, position = desc
                         new_block = Block(block_mesh, orientation, position)
                         p = propogate(new_block)
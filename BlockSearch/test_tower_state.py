@@ -2,11 +2,17 @@ from copy import copy
 
 from BlockSearch.block import Block, ORIENTATIONS, ORIENTATION, Floor
 from BlockSearch.tower_state import Tower_State
+from BlockSearch.nogoods import Nogood_Store
+from BlockSearch import physics as Physics
 from unittest import TestCase
 from stl import mesh
 from BlockSearch.render import *
 from matplotlib.colors import to_rgba
 import time
+import tracemalloc
+import gc
+import math
+from typing import List
 from pprint import pprint as pp
 
 DISPLAY = True #False
@@ -154,21 +160,40 @@ class Tower_State_Test(TestCase):
         self.assertNotEqual(list(tower2._orientation_counter), list(tower2_copy._orientation_counter))
 
     def test_state_copy_time(self):
-        results = dict()
-        l = 6
+        """
+        Benchmark: copies share all containers with their father, so neither copying nor looking blocks up should
+        slow down as the chain of copies grows deeper.
+        """
+        l = 200
+        copy_results = dict()
+        lookup_results = dict()
         copies = dict()
+        tower: Tower_State = Tower_State()
+        depth = 0
         for t in range(10, 100, 20):
-            tower : Tower_State = Tower_State()
-            for new_block in [Block(block_mesh, 'flat_wide', (0, 0, i)) for i in range(1, t)]:
+            # every block is added to a new copy, so a tower of t blocks is t copies deep
+            for new_block in [Block(block_mesh, 'flat_wide', (0, 0, i)) for i in range(depth + 1, t)]:
+                tower = copy(tower)
                 if tower.can_add(new_block):
                     tower.add(new_block)
+            depth = t - 1
 
             s = time.time()
-            copies[t] = [copy(tower) for _ in range(l)]
-            e = time.time() - s
-            results[t] = e / l
-            print(results[t])
-        pp(results)
+            copies[t] = [copy(tower) for _ in range(6)]
+            copy_results[t] = (time.time() - s) / 6
+
+            first_block = Block(block_mesh, 'flat_wide', (0, 0, 1))
+            s = time.time()
+            for _ in range(l):
+                tower.get_blocks_above(first_block)
+                tower.get_by_top(first_block.get_top_level())
+                tower.is_bad_block(first_block)
+            lookup_results[t] = (time.time() - s) / l
+        print("Copy time by depth:")
+        pp(copy_results)
+        print("Lookup time by depth:")
+        pp(lookup_results)
+
         for height, tower_copy_list in copies.items():
             for i, tower in enumerate(tower_copy_list):
                 new_block  = Block(block_mesh, 'flat_wide', (0, i, height))
@@ -182,6 +207,302 @@ class Tower_State_Test(TestCase):
                 self.assertNotEqual(tower1, tower2)
                 self.assertNotEqual(tower1._connectivity, tower2._connectivity)
 
+    def test_add_time(self):
+        """
+        Benchmark: adding a block should not slow down as the tower grows taller. Stability margins are only measured
+        once asked for, see get_stability_index. The timings are printed, the work done by every add is checked: it
+        marks one block, and measures nothing.
+        """
+        l = 30
+        tower: Tower_State = Tower_State()
+        times = []
+        for i in range(1, 150):
+            new_block = Block(block_mesh, 'flat_wide', (0, 0, i))
+            s = time.time()
+            tower = copy(tower)
+            tower._link(new_block)
+            margins = tower._stability_margins
+            tower.add(new_block)
+            times.append(time.time() - s)
+            self.assertIs(tower._stability_margins, margins)
+            self.assertEqual(len(self._get_dirty(tower)), i)
+        low, high = sum(times[:l]) / l, sum(times[-l:]) / l
+
+        s = time.time()
+        index = tower.get_stability_index()
+        e = time.time() - s
+        print("Add at the bottom of a tower: {:.6f}s, at the top: {:.6f}s, first stability index: {:.6f}s".format(
+            low, high, e))
+        self.assertEqual(index, 2)
+        # every dirty block is drained once, and every block off the floor measured
+        self.assertEqual(self._get_dirty(tower), [])
+        self.assertEqual(len(tower._stability_margins), 148)
+
+    @staticmethod
+    def _get_dirty(tower: Tower_State) -> List[Block]:
+        blocks = []
+        dirty = tower._stability_dirty
+        while dirty is not None:
+            block, dirty = dirty
+            blocks.append(block)
+        return blocks
+
+    def test_state_hash(self):
+        blocks = [Block(block_mesh, 'flat_thin', (0, 3 * i, 1)) for i in range(4)]
+        tower1: Tower_State = Tower_State()
+        tower2: Tower_State = Tower_State()
+        for block in blocks:
+            tower1 = copy(tower1)
+            self.assertTrue(tower1.can_add(block))
+            tower1.add(block)
+        for block in reversed(blocks):
+            self.assertTrue(tower2.can_add(block))
+            tower2.add(block)
+
+        # same blocks added in any order are the same state
+        self.assertEqual(hash(tower1), hash(tower2))
+        self.assertEqual(tower1, tower2)
+
+        tower3 = copy(tower2)
+        self.assertEqual(tower2, tower3)
+        new_block = Block(block_mesh, 'flat_thin', (0, 12, 1))
+        self.assertTrue(tower3.can_add(new_block))
+        tower3.add(new_block)
+        self.assertNotEqual(hash(tower2), hash(tower3))
+        self.assertNotEqual(tower2, tower3)
+
+    def test_near_blocks(self):
+        tower: Tower_State = Tower_State(size=60)
+        for x in range(-24, 25, 16):
+            for y in range(-24, 25, 4):
+                new_block = Block(block_mesh, 'flat_thin', (x, y, 1))
+                if tower.can_add(new_block):
+                    tower.add(new_block)
+        level = tower.get_top_off()
+        self.assertGreater(len(tower.get_by_top(level)), 30)
+
+        for x, y in [(0, 0), (-23, 13), (22, -5)]:
+            cover = Block(block_mesh, 'flat_wide', (x, y, level + 1)).get_cover()
+            near = tower.get_by_top_near(level, cover)
+            touching = {b for b in tower.get_by_top(level) if cover.intersects(b.get_cover())}
+            self.assertTrue(touching <= near)
+            self.assertLess(len(near), len(tower.get_by_top(level)))
+
+    def test_floor_overlap(self):
+        # the floor is never written into the voxel grid, a huge floor costs nothing to start from
+        tower: Tower_State = Tower_State(size=2000)
+        self.assertEqual(len(tower._occupancy), 0)
+        self.assertTrue(tower.overlaps(Block(block_mesh, 'flat_wide', (999, 0, 0))))
+        self.assertFalse(tower.overlaps(Block(block_mesh, 'flat_wide', (999, 0, 1))))
+        self.assertFalse(tower.overlaps(Block(block_mesh, 'flat_wide', (1100, 0, 0))))
+        self.assertTrue(tower.overlaps(Block(block_mesh, 'tall_wide', (0, 0, 3))))
+        self.assertFalse(tower.overlaps(Block(block_mesh, 'tall_wide', (0, 0, 8))))
+
+        tower.add(Block(block_mesh, 'flat_wide', (0, 0, 1)))
+        self.assertTrue(tower.overlaps(Block(block_mesh, 'flat_thin', (0, 0, 1))))
+        self.assertFalse(tower.overlaps(Block(block_mesh, 'flat_thin', (0, 0, 2))))
+
+    def test_floor_near(self):
+        # the floor is kept out of the spatial buckets, it is only found when a cover lies over it
+        tower: Tower_State = Tower_State(size=2000)
+        self.assertEqual(len(tower._top_buckets), 0)
+        on_floor = Block(block_mesh, 'flat_wide', (0, 0, 1)).get_cover()
+        off_floor = Block(block_mesh, 'flat_wide', (1100, 0, 1)).get_cover()
+        self.assertEqual(tower.get_by_top_near(0, on_floor), {tower.floor})
+        self.assertEqual(tower.get_by_top_near(0, off_floor), set())
+        self.assertEqual(tower.get_by_top_near(1, on_floor), set())
+
+        # blocks on the floor still find it below them
+        block = Block(block_mesh, 'flat_wide', (0, 0, 1))
+        self.assertTrue(Physics.is_stable(tower, block))
+        self.assertEqual(set(tower.get_blocks_below(block)), {tower.floor})
+
+    def test_nogoods(self):
+        tower: Tower_State = Tower_State()
+        base = Block(block_mesh, 'flat_thin', (0, 0, 1))
+        self.assertTrue(tower.can_add(base))
+        tower.add(base)
+
+        # a failure found in one sibling is shared with the other, and is not checked again
+        sibling1, sibling2 = copy(tower), copy(tower)
+        self.assertFalse(sibling1.can_add(Block(block_mesh, 'flat_thin', (10, 0, 2))))
+        self.assertEqual(sibling1.get_nogoods().hits, 0)
+        self.assertFalse(sibling2.can_add(Block(block_mesh, 'flat_thin', (10, 0, 2))))
+        self.assertEqual(sibling2.get_nogoods().hits, 1)
+        self.assertEqual(sibling2._bad_block_calls, 1)
+
+        store = Nogood_Store(capacity=100)
+        for key in range(1, 1000):
+            store.add(key * 0x9e3779b97f4a7c15 & ((1 << 64) - 1))
+        self.assertLessEqual(len(store), 200)
+        # the most recent keys are always remembered
+        self.assertTrue(all(key * 0x9e3779b97f4a7c15 & ((1 << 64) - 1) in store for key in range(900, 1000)))
+
+    def test_blocks_between(self):
+        tower: Tower_State = Tower_State()
+        for i, orientation in enumerate(['tall_wide', 'flat_wide', 'short_thin', 'tall_thin']):
+            new_block = Block(block_mesh, orientation, (20 * i - 30, 0, 8))
+            new_block = Block(block_mesh, orientation, (20 * i - 30, 0, 8 - new_block.get_bottom_level() + 1))
+            self.assertTrue(tower.can_add(new_block))
+            tower.add(new_block)
+        self.assertEqual(list(tower.keys()), sorted(tower.keys()))
+
+        every_block = list(tower.gen_blocks(no_floor=False))
+        for low in range(-1, 20):
+            for high in range(low, 20):
+                expected = {b for b in every_block if b.get_bottom_level() <= high and b.get_top_level() >= low}
+                self.assertEqual(set(tower.gen_blocks_between(low, high)), expected, (low, high))
+
+    def test_save_load(self):
+        """
+        Benchmark: size of a saved tower, and how fast saved towers are loaded
+        """
+        for tower in [Tower_State(size=30), Tower_State(30, True, None, 3, 1, 10)]:
+            for _ in range(3):
+                for father_block in list(tower.gen_blocks(no_floor=False)):
+                    for son_desc in father_block.gen_possible_block_descriptors(
+                            limit_orientation=lambda o: father_block.is_perpendicular(o), limit_len=200,
+                            random_order=False):
+                        son_block = Block(block_mesh, *son_desc)
+                        if not tower.is_bad_block(son_block) and tower.can_add(son_block):
+                            tower.add(son_block)
+            num_of_blocks = len(list(tower.gen_blocks()))
+            self.assertGreater(num_of_blocks, 10)
+
+            for with_connectivity in [True, False]:
+                data = tower.to_bytes(with_connectivity)
+                l = 10
+                s = time.time()
+                for _ in range(l):
+                    loaded = Tower_State.from_bytes(data)
+                e = (time.time() - s) / l
+                print("{}, connectivity: {}, {} blocks, {:.1f} bytes per block, {:.0f} blocks loaded per second".format(
+                    tower.floor, with_connectivity, num_of_blocks, len(data) / num_of_blocks, num_of_blocks / e))
+
+                self.assertEqual(loaded, tower)
+                self.assertEqual(list(loaded.gen_blocks()), list(tower.gen_blocks()))
+                for block in tower.gen_blocks(no_floor=False):
+                    self.assertEqual(set(loaded.get_blocks_below(block)), set(tower.get_blocks_below(block)))
+                    self.assertEqual(set(loaded.get_blocks_above(block)), set(tower.get_blocks_above(block)))
+                    self.assertEqual(loaded.get_covered_cells(block), tower.get_covered_cells(block))
+                self.assertEqual(loaded.get_stability_index(), tower.get_stability_index())
+
+    def test_fast_render(self):
+        """
+        Benchmark: a fast render is a view of the triangles written as blocks were added, against concatenating the
+        mesh of every block
+        """
+        tower: Tower_State = Tower_State()
+        self.assertEqual(len(tower.render(fast=True).data), 0)
+
+        father = copy(tower)
+        base = Block(block_mesh, 'flat_wide', (0, 0, 1))
+        self.assertTrue(father.can_add(base))
+        father.add(base)
+        # the father's triangles are shared: the first son appends in place, the others continue on a copy, only
+        # once they render
+        father.render(fast=True)
+        sons = []
+        for y in range(-12, 13, 3):
+            son = copy(father)
+            son_block = Block(block_mesh, 'flat_thin', (0, y, 2))
+            if son.can_add(son_block):
+                son.add(son_block)
+                sons.append(son)
+        self.assertGreater(len(sons), 2)
+        for son in sons:
+            self.assertIs(son._mesh_buffer, father._mesh_buffer)
+        # siblings never rendered hold no triangles of their own
+        self.assertEqual(father._mesh_buffer.length, 2 * len(block_mesh.data))
+        sons[1].render(fast=True)
+        self.assertIsNot(sons[1]._mesh_buffer, father._mesh_buffer)
+        self.assertLessEqual(len(sons[1]._mesh_buffer.data), 2 * sons[1]._mesh_length)
+        self.assertIs(sons[2]._mesh_buffer, father._mesh_buffer)
+        sons = sons[:2]
+        # a wide tower, a tall one outgrows the recursion of the stability check
+        grandson = copy(sons[0])
+        for z in range(1, 6):
+            for x in range(-30, 30, 3):
+                for y in range(-75, 75, 15):
+                    new_block = Block(block_mesh, 'flat_wide', (x, y, z))
+                    if grandson.can_add(new_block):
+                        grandson.add(new_block)
+        self.assertGreater(len(list(grandson.gen_blocks())), 500)
+
+        self.assertEqual(len(tower.render(fast=True).data), 0)
+        for state in [father] + sons + [grandson]:
+            fast = state.render(fast=True)
+            slow = combine(state.render())
+            np.testing.assert_allclose(fast.vectors, slow.vectors, atol=1e-4)
+            np.testing.assert_allclose(fast.normals, slow.normals, atol=1e-4)
+            self.assertTrue(np.shares_memory(fast.data, state._mesh_buffer.data))
+            # the buffer is shared, renders cannot write to it
+            with self.assertRaises(ValueError):
+                fast.vectors[0] = 0
+
+        l = 100
+        s = time.time()
+        for _ in range(l):
+            grandson.render(fast=True)
+        fast_elapse = (time.time() - s) / l
+        s = time.time()
+        for _ in range(l):
+            combine(grandson.render())
+        slow_elapse = (time.time() - s) / l
+        print("Render of {} blocks, fast: {:.6f}s, concatenated: {:.6f}s".format(
+            len(list(grandson.gen_blocks())), fast_elapse, slow_elapse))
+
+    def test_fringe_memory(self):
+        """
+        Benchmark: memory held by each leaf state of a search fringe, by depth of the search. Leaves are built once
+        through the stability check, which also memoizes a result per block below, and once without it.
+        """
+        results = dict()
+        tower: Tower_State = Tower_State()
+        depth = 0
+        for target_depth in [10, 50, 100]:
+            while depth < target_depth:
+                tower = copy(tower)
+                depth += 1
+                new_block = Block(block_mesh, 'flat_wide', (0, 0, depth))
+                self.assertTrue(tower.can_add(new_block))
+                tower.add(new_block)
+
+            sons = [Block(block_mesh, 'flat_thin', (0, y, depth + 1)) for y in range(-5, 6)]
+            for son in sons:
+                son.get_footprint().chunks()
+            results[depth] = []
+            for check_stability in [False, True]:
+                tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+                fringe = []
+                for son in sons:
+                    leaf = copy(tower)
+                    if check_stability:
+                        self.assertTrue(leaf.can_add(son))
+                    else:
+                        leaf._link(son)
+                    leaf.add(son)
+                    fringe.append(leaf)
+                results[depth].append((tracemalloc.get_traced_memory()[0] - before) / len(fringe))
+                tracemalloc.stop()
+        print("Bytes per fringe state by depth (state only, with stability check):")
+        pp(results)
+
+    def test_no_father_chain(self):
+        gc.collect()
+        alive = len([o for o in gc.get_objects() if isinstance(o, Tower_State)])
+        tower: Tower_State = Tower_State()
+        for i in range(1, 30):
+            tower = copy(tower)
+            new_block = Block(block_mesh, 'flat_wide', (0, 0, i))
+            tower._link(new_block)
+            tower.add(new_block)
+        gc.collect()
+        # only the last state is referenced, its fathers are gone
+        self.assertEqual(len([o for o in gc.get_objects() if isinstance(o, Tower_State)]), alive + 1)
+        self.assertEqual(len(list(tower.gen_blocks())), 29)
+
     def test_iteration(self):
         tower: Tower_State = Tower_State()
         for new_block in [Block(block_mesh, 'flat_wide', (0, 0, i)) for i in range(1, 10)]:
@@ -214,6 +535,105 @@ class Tower_State_Test(TestCase):
             self.assertLessEqual(size, prev)
             prev = size
 
+    def test_cover_areas(self):
+        tower: Tower_State = Tower_State(30, True, None, 3, 1, 10)
+        rings = tower.floor.get_ring_covers()
+        self.assertEqual(tower._starting_cover_size, sum(len(ring) for ring in rings))
+        self.assertEqual(tower.get_ring_cover_areas(0), (0, 0))
+        self.assertEqual(tower.get_ring_cover_fraction(0), 0)
+
+        # a block across the inner ring
+        base = Block(block_mesh, 'flat_wide', (-8, 0, 1))
+        self.assertTrue(tower.can_add(base))
+        son = copy(tower)
+        son.add(base)
+        self.assertEqual(tower.get_cover_area_at_level(0), 0)
+        self.assertEqual(son.get_cover_area_at_level(0), len(base.get_cover()))
+        self.assertEqual(set(son.get_cover_at_level(0)), base.get_cover_cells())
+        self.assertEqual(son.get_cover_area_at_level(base.get_top_level() + 1), 0)
+
+        on_inner_ring = len(base.get_cover_cells() & rings[0].cells())
+        self.assertGreater(on_inner_ring, 0)
+        self.assertEqual(son.get_ring_cover_areas(0), (on_inner_ring, 0))
+        self.assertAlmostEqual(son.get_ring_cover_fraction(0), on_inner_ring / tower._starting_cover_size)
+
+        # blocks far past the floor only add the tiles under them
+        far = Block(block_mesh, 'flat_wide', (80, -80, 1))
+        tiles = len(son._cover_by_top[far.get_top_level()]._tiles)
+        son.add(far)
+        self.assertEqual(len(son._cover_by_top[far.get_top_level()]._tiles), tiles + len(far.get_cover().chunks()))
+        self.assertEqual(set(son.get_cover_at_level(0)), base.get_cover_cells() | far.get_cover_cells())
+        self.assertEqual(son.get_ring_cover_areas(0), (on_inner_ring, 0))
+
+    def test_stability_index(self):
+        tower: Tower_State = Tower_State()
+        base = Block(block_mesh, 'flat_wide', (0, 0, 1))
+        self.assertTrue(tower.can_add(base))
+        tower.add(base)
+        self.assertEqual(tower.get_stability_index(), math.inf)
+
+        # a flat wide block is 3 cells across, its center of gravity is 2 cells away from the edge of its support
+        middle = Block(block_mesh, 'flat_wide', (0, 0, 2))
+        self.assertTrue(tower.can_add(middle))
+        tower.add(middle)
+        self.assertEqual(tower.get_stability_index(), 2)
+
+        # a block off center moves the center of gravity of the block below it towards an edge
+        son = copy(tower)
+        top = Block(block_mesh, 'flat_wide', (1, 0, 3))
+        self.assertTrue(son.can_add(top))
+        son.add(top)
+        self.assertEqual(son.get_stability_margin(top), 1)
+        self.assertEqual(son.get_stability_margin(middle), 1.5)
+        self.assertEqual(son.get_stability_index(), 1)
+        self.assertEqual(tower.get_stability_index(), 2)
+
+        # siblings share the blocks below, yet each measures them with its own blocks above, whichever asks first
+        for centered_first in (True, False):
+            centered, shifted = copy(tower), copy(tower)
+            for sibling, position in ((centered, (0, 0, 3)), (shifted, (1, 0, 3))):
+                block = Block(block_mesh, 'flat_wide', position)
+                self.assertTrue(sibling.can_add(block))
+                sibling.add(block)
+            if centered_first:
+                self.assertEqual(centered.get_stability_margin(middle), 2)
+            self.assertEqual(shifted.get_stability_margin(middle), 1.5)
+            self.assertEqual(centered.get_stability_margin(middle), 2)
+
+        # margins kept along support paths are the margins measured from scratch
+        for _ in range(3):
+            for father_block in list(son.gen_blocks(no_floor=False)):
+                for son_desc in father_block.gen_possible_block_descriptors(
+                        limit_orientation=lambda o: father_block.is_perpendicular(o), limit_len=50,
+                        random_order=False):
+                    son_block = Block(block_mesh, *son_desc)
+                    if not son.is_bad_block(son_block) and son.can_add(son_block):
+                        son.add(son_block)
+        margins = {block: Physics.get_stability_margin(son, block) for block in son.gen_blocks()}
+        for block, margin in margins.items():
+            self.assertEqual(son.get_stability_margin(block), margin)
+        self.assertEqual(son.get_stability_index(), min(margins.values()))
+
+    def test_covered_cells(self):
+        tower: Tower_State = Tower_State()
+        base = Block(block_mesh, 'flat_wide', (0, 0, 1))
+        self.assertTrue(tower.can_add(base))
+        tower.add(base)
+        self.assertEqual(tower.get_covered_cells(base), 0)
+
+        son = Block(block_mesh, 'flat_thin', (1, 1, 2))
+        self.assertTrue(tower.can_add(son))
+        tower.add(son)
+        covered = base.get_cover().covered_by([son.get_cover()])
+        self.assertEqual(tower.get_covered_cells(base), covered)
+
+        # counts are inherited by copies, and kept apart from them
+        copied_tower = copy(tower)
+        self.assertEqual(copied_tower.get_covered_cells(base), covered)
+        copied_tower.disconnect_block_from_neighbors(son)
+        self.assertEqual(copied_tower.get_covered_cells(base), 0)
+        self.assertEqual(tower.get_covered_cells(base), covered)
+
     def test_perp_tower(self):
         STAGE = 10
         tower: Tower_State = Tower_State(size=30, ring_floor=True)
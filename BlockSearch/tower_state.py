@@ -1,24 +1,125 @@
+from collections import OrderedDict
 from copy import copy
 
 from memoized import memoized
 
 from BlockSearch import physics as Physics
-from BlockSearch.block import Block, Floor, ORIENTATIONS, RingFloor
+from BlockSearch.block import Block, Floor, ORIENTATIONS, RingFloor, DESCRIPTOR_DTYPE, ORIENTATION_TO_INDEX, block_mesh, \
+    init_rotated_mesh
+from BlockSearch.footprint import Cell_Mask, Cell_Tiles, Voxel_Grid
+from BlockSearch.nogoods import Nogood_Store
+from BlockSearch.persistent import PMap, PSet, EMPTY_PMAP, EMPTY_PSET
 from stl import mesh
-from typing import List, Set, Dict, Tuple, Optional, Generator
+from typing import List, Set, Dict, Tuple, Optional, Generator, Iterable
+import math
 import numpy as np
+import struct
 
 
 floor_mesh = mesh.Mesh.from_file('floor.stl')
 
 FLOOR_LEVEL = 0
+# Maximal number of spreads remembered by a search, least recently used spreads are forgotten first
+SPREADS_MEMORY_SIZE = 2 ** 16
+# Blocks of a level are indexed by the buckets of 2 ** SPATIAL_BUCKET_BITS by 2 ** SPATIAL_BUCKET_BITS XY cells their
+# covers touch, see get_by_top_near
+SPATIAL_BUCKET_BITS = 3
+# Number of failed placements remembered by a search, see Nogood_Store
+NOGOODS_MEMORY_SIZE = 2 ** 16
 NEIGHBOR_BELOW = 0
 NEIGHBOR_ABOVE = 1
+COVERED_CELLS = 2
+# Binary format of a saved tower (see Tower_State.to_bytes): a header, the blocks' descriptors, then optionally the
+# links between blocks
+SAVE_MAGIC = b'TWRS'
+SAVE_VERSION = 1
+SAVE_HEADER = struct.Struct('<4sBBIiiii')  # magic, version, flags, blocks, floor size, ring size, rings, ring distance
+SAVE_RING_FLOOR = 1
+SAVE_CONNECTIVITY = 2
+# Links are (block, block below) pairs of indices into the saved blocks, the floor is -1
+LINK_DTYPE = np.dtype([('block', np.int32), ('below', np.int32)])
 X = 0
 Y = 1
 Z = 2
 
+_NO_NEIGHBORS = ((), (), 0)
+ZOBRIST_MASK = (1 << 64) - 1
+
+
+def zobrist_key(block_key: int) -> int:
+    """
+    Pseudo random 64 bit value of a block key (the splitmix64 finalizer). The hash of a state is the XOR of the
+    values of its blocks, so it is updated in O(1) as blocks are added, regardless of the order they were added in.
+    """
+    h = block_key & ZOBRIST_MASK
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & ZOBRIST_MASK
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & ZOBRIST_MASK
+    return h ^ (h >> 31)
+
+
+class Mesh_Buffer():
+    """
+    Growable array of the triangles of blocks, in the order they were added, shared by a state and the states copied
+    from it. A state holds a buffer and the number of its triangles at the buffer's start. A state may append in
+    place as long as no other state has appended past its triangles, otherwise it continues on a copy of its own
+    triangles. Triangles already written never change, so every state sharing a buffer reads its own triangles as
+    they were. States only copy once rendered, see Tower_State.render
+
+                  state A: 3 blocks      B copied from A, adds a block      C copied from A, adds a block, renders
+        buffer 1: | a | a | a |          | a | a | a | b |                  (B appended past A)
+        buffer 2:                                                           | a | a | a | c |
+    """
+    __slots__ = ('data', 'length')
+
+    def __init__(self, capacity: int):
+        self.data = np.zeros(capacity, dtype=mesh.Mesh.dtype)
+        #  Number of triangles written, by any state
+        self.length = 0
+
+    def append(self, length: int, blocks: List[Block]) -> 'Mesh_Buffer':
+        """
+        :param length: number of triangles of the appending state
+        :param blocks: blocks to append after the state's triangles
+        :return: The buffer holding the state's triangles followed by the blocks', this buffer or a copy of it
+        """
+        templates = [init_rotated_mesh(block.orientation).data for block in blocks]
+        end = length + sum(len(template) for template in templates)
+        buffer = self
+        if length != self.length:
+            buffer = Mesh_Buffer(2 * end)
+            buffer.data[:length] = self.data[:length]
+        elif end > len(self.data):
+            # States holding this buffer only read their own triangles, which are all copied
+            data = np.zeros(2 * end, dtype=mesh.Mesh.dtype)
+            data[:length] = self.data[:length]
+            self.data = data
+
+        for block, template in zip(blocks, templates):
+            start, length = length, length + len(template)
+            buffer.data[start:length] = template
+            # Translate to correct position, same as Block._init_translation
+            buffer.data['vectors'][start:length] += np.array(block.position, dtype=np.float32)
+        buffer.length = length
+        return buffer
+
+    def view(self, length: int) -> mesh.Mesh:
+        """
+        :return: A read only mesh of the first triangles of the buffer, sharing its memory
+        """
+        data = self.data[:length]
+        data.setflags(write=False)
+        return mesh.Mesh(data, calculate_normals=False)
+
+
 class Tower_State():
+    # Leaf states fill the search's fringe, keep them small
+    __slots__ = ('floor', '_bad_block_calls', '_order_added', '_max_level', '_blocks_by_top_level',
+                 '_blocks_by_bottom_level', '_top_level_bits', '_max_height', '_connectivity',
+                 '_top_buckets', '_bottom_buckets', '_occupancy', '_orientation_counter', '_bad_block_hashes',
+                 '_spreads_memory', '_nogoods', '_hash', '_cover_by_top', '_ring_covers',
+                 '_starting_cover_size', '_stability_margins', '_stability_index', '_least_stable',
+                 '_stability_dirty',
+                 '_mesh_buffer', '_mesh_length', '_mesh_pending')
 
     _orientation_to_index = dict()
     _index_to_orientation = dict()
@@ -29,69 +130,136 @@ class Tower_State():
 
 
     def __init__(self, size=30, ring_floor=False, father_state=None, *args):
+        """
+        All the containers of a state are persistent (see BlockSearch.persistent): a copied state shares them with
+        its father, and every change builds new versions in O(log n) without touching the father's. A state holds no
+        link to its father, so its lineage never needs compacting and fathers no longer referenced are collected.
+        :param father_state: no longer supported, kept in place for the ring floor's positional arguments
+        """
         self._bad_block_calls = 0
-        self._order_added = []
-        self._updated_top = set()
-        self._updated_bottom = set()
-        self._updated = set()
-        self._mem = set()
+        # Blocks in the order they were added, newest first, as nested (block, rest) pairs shared with the fathers
+        self._order_added: Optional[Tuple[Block, tuple]] = None
         self._max_level = 0
-        self._blocks_by_top_level: Dict[int: Set[Block]] = dict()
-        self._blocks_by_bottom_level: Dict[int: Set[Block]] = dict()
-        self._connectivity: Dict[Block: List[Set[Block], Set[Block]]] = dict()
-        if not father_state: # this is son
-            if not ring_floor:
-                floor = Floor(floor_mesh, size)
-            else:
-                floor = RingFloor(floor_mesh, size, *args)
-            self.floor = floor
-            self._blocks_by_top_level[FLOOR_LEVEL] = {floor,}
-            self._connectivity[floor] = [set(), set()]
-            self._orientation_counter: np.ndarray = np.zeros(shape=(6,))
+        self._blocks_by_top_level: PMap = EMPTY_PMAP  # level -> PSet of blocks
+        self._blocks_by_bottom_level: PMap = EMPTY_PMAP  # level -> PSet of blocks
+        # Top levels in use, bit (level - FLOOR_LEVEL) is set for every level, and the tallest block. See
+        # gen_blocks_between
+        self._top_level_bits = 0
+        self._max_height = 0
+        # block -> (tuple of blocks below, tuple of blocks above, number of cover cells covered by the blocks above).
+        # Blocks have few neighbors, a tuple is the most compact container to keep and the fastest to walk. See
+        # get_covered_cells
+        self._connectivity: PMap = EMPTY_PMAP
+        # (level, bucket x, bucket y) -> PSet of blocks, see get_by_top_near. The floor would fill a bucket per 64
+        # cells, it is left out
+        self._top_buckets: PMap = EMPTY_PMAP
+        self._bottom_buckets: PMap = EMPTY_PMAP
+        # Cells occupied by all added blocks. The floor is left out, its cells grow with the square of its size, see
+        # overlaps
+        self._occupancy = Voxel_Grid()
+        assert father_state is None, "States do not link to their fathers, copy a state to derive a son from it"
+        if not ring_floor:
+            floor = Floor(floor_mesh, size)
         else:
-            self.floor = None
-            self._orientation_counter = None
+            floor = RingFloor(floor_mesh, size, *args)
+        self.floor = floor
+        self._blocks_by_top_level = self._blocks_by_top_level.set(FLOOR_LEVEL, EMPTY_PSET.add(floor))
+        self._top_level_bits = 1
+        self._max_height = 1
+        self._connectivity = self._connectivity.set(floor, _NO_NEIGHBORS)
+        # Number of blocks added by orientation. A tuple, so copies share it until they add a block
+        self._orientation_counter: Tuple[int, ...] = (0,) * len(ORIENTATIONS)
 
         #  Remembers bad blocks that should not consume any more time resources
-        self._bad_block_hashes = set()
-        self._spreads_memory: Dict[Tuple[Block, Block]: Set[Block]] = dict()
-        # self._cover_cells_at_level: Dict[int: Set[Tuple[int, int]]] = dict()
-        # self._starting_cover_size = (size**2 - (size-3)**2)
-        self._father_state: Tower_State = father_state
-        self._gen_str()
-
-    def add_bad_block(self, block : Block or str):
+        self._bad_block_hashes: PSet = EMPTY_PSET
+        self._spreads_memory: Dict[Tuple[Block, Block]: Cell_Mask] = OrderedDict()
+        # Placements that failed in any state of the search, in the context of their neighbors
+        self._nogoods = Nogood_Store(NOGOODS_MEMORY_SIZE)
+        # level -> Cell_Tiles of the covers of all blocks whose top is at level, the floor excluded. An add only
+        # touches the tiles under the block. See get_cover_at_level
+        self._cover_by_top: PMap = EMPTY_PMAP
+        # Cells of every ring of a ring floor
+        self._ring_covers: Tuple[Cell_Tiles, ...] = ()
+        if isinstance(floor, RingFloor):
+            self._ring_covers = tuple(Cell_Tiles().add(ring) for ring in floor.get_ring_covers())
+        self._starting_cover_size = len(floor.get_cover())
+        # block -> stability margin of every block not standing on the floor (see Physics.get_stability_margin), and
+        # the least margin of all, with its block. See get_stability_index
+        self._stability_margins: PMap = EMPTY_PMAP
+        self._stability_index = math.inf
+        self._least_stable: Optional[Block] = None
+        # Blocks added since margins were last measured, newest first, as nested (block, rest) pairs
+        self._stability_dirty: Optional[Tuple[Block, tuple]] = None
+        # Triangles of all blocks, only once rendered fast, and the blocks added since that could not be appended in
+        # place, newest first as nested (block, rest) pairs. See render
+        self._mesh_buffer: Optional[Mesh_Buffer] = None
+        self._mesh_length = 0
+        self._mesh_pending: Optional[Tuple[Block, tuple]] = None
+        # State identity, an XOR of the Zobrist keys of all blocks (see zobrist_key)
+        self._hash = 0
+
+    def add_bad_block(self, block : Block or int):
         """
-        Will hash a block, or a string representing a block, and add it to the bad boy list. We assume
+        Will add a block, or a key representing a block, to the bad boy list. We assume
         this was not already conducted for this specific block.
-        :param block: The block object or it's str representation (not repr! which is cog sensitive)
+        :param block: The block object or it's key (see Block.gen_key and Block.gen_context_key)
         :return:
         """
-        h = hash(block)
-        assert h not in self._bad_block_hashes
-        self._bad_block_hashes.add(h)
+        key = block if type(block) == int else block.get_key()
+        assert key not in self._bad_block_hashes
+        self._bad_block_hashes = self._bad_block_hashes.add(key)
 
-    def stringify_block_neighbors(self, block):
+    def gen_block_neighbors_key(self, block) -> int:
         # A block state can be uniquely described by a block descriptor,
         # along with the number or neighbors above and below.
         # Should a change be made in the future to the neighbors of this block,
         # this will no longer be the same descriptor.
-        block_connectivity_symbol = "{}{}{}".format(str(block),
-                                                    len(self._connectivity[block][NEIGHBOR_BELOW]),
-                                                    len(self._connectivity[block][NEIGHBOR_ABOVE])
-                                                    )
-        return block_connectivity_symbol
+        return Block.gen_context_key(block.get_key(),
+                                     len(self.get_blocks_below(block)),
+                                     len(self.get_blocks_above(block)))
+
+    def gen_nogood_key(self, block: Block) -> int:
+        """
+        Hashes a block along with the blocks directly below and above it. The same placement with the same neighbors
+        has the same key in every state of the search, see Nogood_Store.
+        """
+        below = 0
+        for block_below in self.get_blocks_below(block):
+            below ^= zobrist_key(block_below.get_key())
+        above = 0
+        for block_above in self.get_blocks_above(block):
+            above ^= zobrist_key(block_above.get_key())
+        # Rotate the blocks above, so a block is told apart below and above
+        above = ((above << 1) | (above >> 63)) & ZOBRIST_MASK
+        return zobrist_key(block.get_key()) ^ below ^ above
 
     def add_bad_block_state(self, block : Block):
-        stringify = self.stringify_block_neighbors(block)
-        self.add_bad_block(stringify)
+        self.add_bad_block(self.gen_block_neighbors_key(block))
+        self._nogoods.add(self.gen_nogood_key(block))
+
+    def is_bad_block_state(self, block: Block) -> bool:
+        """
+        :return: True iff this block already failed with the same neighbors, in this state (or a father state) or in
+                 any other state of the search
+        """
+        if self.is_bad_block(self.gen_block_neighbors_key(block), is_key=True):
+            return True
+        if self.gen_nogood_key(block) in self._nogoods:
+            self._bad_block_calls += 1
+            return True
+        return False
+
+    def get_nogoods(self) -> Nogood_Store:
+        return self._nogoods
 
-    def is_bad_block(self, block : Block or str, is_hash=False):
-        if not is_hash:
-            block = hash(block)
+    def is_bad_block(self, block : Block or int, is_key=False):
+        """
+        :param block: The block object or it's key (see Block.gen_key and Block.gen_context_key)
+        :param is_key: skip the conversion of block to a key
+        """
+        if not is_key and type(block) != int:
+            block = block.get_key()
         if not block in self._bad_block_hashes:
-            if self._father_state:
-                return self._father_state.is_bad_block(block, is_hash=True)
             return False
         self._bad_block_calls += 1
         return True
@@ -103,13 +271,21 @@ class Tower_State():
         filter_blocks = lambda b: not b.is_saturated(self) if filter_saturated_block else lambda b: True
         if not no_floor:
             yield self.floor
-        if self._father_state:
-            for block in self._father_state.gen_blocks(no_floor=no_floor,
-                                                       filter_saturated_block=filter_saturated_block):
-                yield block
-        for block in filter(filter_blocks, self._order_added):
+        for block in filter(filter_blocks, self._gen_order_added()):
             yield block
 
+    def _gen_order_added(self) -> List[Block]:
+        """
+        :return: All added blocks, oldest first
+        """
+        blocks = []
+        node = self._order_added
+        while node is not None:
+            block, node = node
+            blocks.append(block)
+        blocks.reverse()
+        return blocks
+
         # filter_orientations = orientation_filter if orientation_filter else lambda o: True
         # for level in sorted(filter(floor_condition, self._blocks_by_top_level.keys()), reverse=True):
         #     for block in self._blocks_by_top_level[level]:
@@ -123,19 +299,56 @@ class Tower_State():
 
 
 
-    # def get_cover_at_level(self, level: int):
-    #     """
-    #     Cover is all the cells on the XY plane the this building has pieces above. So a cover at a given level is
-    #     defined as the projection of the tower onto the XY plane at a given height. Whatever is below the height is
-    #     ignored.
-    #     :param level:
-    #     :return:
-    #     """
-    #     ret = set()
-    #     assert self._father_state is None
-    #     for i in filter(lambda l: l in self._cover_cells_at_level, range(level, self._max_level + 1)):
-    #         ret |= self._cover_cells_at_level[i]
-    #     return ret
+    def get_cover_at_level(self, level: int) -> Cell_Tiles:
+        """
+        Cover is all the cells on the XY plane the this building has pieces above. So a cover at a given level is
+        defined as the projection of the tower onto the XY plane at a given height. Whatever is below the height is
+        ignored. The floor is not part of the cover.
+
+        Covers are kept by top level, updated in O(cover) on add, so a cover is the union of the tiles of every top
+        level in use above the given level, without visiting any block.
+        :param level:
+        :return: Read only set of the covered (x, y) cells
+        """
+        cover = Cell_Tiles()
+        for top in Tower_State._gen_levels(self._top_level_bits >> max(level - FLOOR_LEVEL, 0),
+                                           max(level, FLOOR_LEVEL)):
+            tiles = self._cover_by_top.get(top)
+            if tiles is not None:
+                cover = cover.union(tiles)
+        return cover
+
+    def get_cover_area_at_level(self, level: int) -> int:
+        """
+        :return: Number of cells in the cover at the given level, see get_cover_at_level
+        """
+        return len(self.get_cover_at_level(level))
+
+    def get_ring_cover_areas(self, level: int) -> Tuple[int, ...]:
+        """
+        :return: For every ring of a ring floor, from the innermost out, the number of its cells in the cover at the
+        given level. Empty for a plain floor
+        """
+        cover = self.get_cover_at_level(level)
+        return tuple(cover.intersection_size(ring) for ring in self._ring_covers)
+
+    def get_ring_cover_fraction(self, level: int) -> float:
+        """
+        :return: Fraction of the ring floor's cells in the cover at the given level, 0 for a plain floor
+        """
+        # rings may share cells, count each cell once
+        rings = Cell_Tiles()
+        for ring in self._ring_covers:
+            rings = rings.union(ring)
+        if not rings:
+            return 0.0
+        return self.get_cover_at_level(level).intersection_size(rings) / len(rings)
+
+    def _add_cover(self, level: int, cover):
+        """
+        Adds a block's cover to the covers at its top level, copy on write
+        """
+        self._cover_by_top = self._cover_by_top.set(level, self._cover_by_top.get(level, Cell_Tiles()).add(cover))
 
     def get_spread(self, block1: Block, block2: Block):
         """
@@ -147,7 +360,7 @@ class Tower_State():
         Spread is commutative
         :param block1:
         :param block2:
-        :return:
+        :return: A read only set of the spread's 2D cells, backed by a bitmask (see Cell_Mask)
         """
 
         assert block1.get_top_level() == block2.get_top_level(), str(block1) + str(block1.get_top_level()) + str(block2) + str(
@@ -159,35 +372,30 @@ class Tower_State():
 
         ordered_pair = (block1, block2) if block1 < block2 else (block2, block1)
         if ordered_pair in self._spreads_memory: # shared with father
+            self._spreads_memory.move_to_end(ordered_pair)
             return self._spreads_memory[ordered_pair]
 
-        b1_cover_x = {cell[X] for cell in block1.get_cover_cells()}
-        b2_cover_x = {cell[X] for cell in block2.get_cover_cells()}
+        cover1 = block1.get_cover()
+        cover2 = block2.get_cover()
+        if not (cover1.is_solid() and cover2.is_solid()):
+            spread = self._gen_spread_from_cells(block1, block2)
+            self._remember_spread(ordered_pair, spread)
+            return spread
 
-        b1_cover_y = {cell[Y] for cell in block1.get_cover_cells()}
-        b2_cover_y = {cell[Y] for cell in block2.get_cover_cells()}
-
-        inter_x = b1_cover_x & b2_cover_x
-        inter_y = b1_cover_y & b2_cover_y
+        # Both covers are boxes, and so is every piece of the spread between them. Boxes are (low, high) corners.
+        (low_x1, low_y1), (high_x1, high_y1) = box1 = cover1.get_origin(), cover1.get_end()
+        (low_x2, low_y2), (high_x2, high_y2) = box2 = cover2.get_origin(), cover2.get_end()
+        low = (min(low_x1, low_x2), min(low_y1, low_y2))
+        high = (max(high_x1, high_x2), max(high_y1, high_y2))
+        boxes = [box1, box2]
 
-        spread = set()
-        spread |= block1.get_cover_cells()
-        spread |= block2.get_cover_cells()
-        if (inter_x):
-            union_y = b1_cover_y | b2_cover_y
-            min_y = int(min(union_y))
-            max_y = int(max(union_y))
-            for y in range(min_y, max_y + 1):
-                for x in inter_x:
-                    spread.add((x, y))
+        inter_x = range(max(low_x1, low_x2), min(high_x1, high_x2))
+        inter_y = range(max(low_y1, low_y2), min(high_y1, high_y2))
+        if inter_x:
+            boxes.append(((inter_x.start, low[Y]), (inter_x.stop, high[Y])))
 
-        elif (inter_y):
-            union_x = b1_cover_x | b2_cover_x
-            min_x = int(min(union_x))
-            max_x = int(max(union_x))
-            for x in range(min_x, max_x + 1):
-                for y in inter_y:
-                    spread.add((x, y))
+        elif inter_y:
+            boxes.append(((low[X], inter_y.start), (high[X], inter_y.stop)))
 
         else:  # no common pieces - skew lines
             """
@@ -199,21 +407,60 @@ class Tower_State():
 
             Relevant for flat pieces only.
             """
-            pass
             # See if the candidate blocks above can help increase spread
-            candidate_blocks = self.get_blocks_above(block1) & self.get_blocks_above(block2)
+            candidate_blocks = set(self.get_blocks_above(block1)).intersection(self.get_blocks_above(block2))
 
             if candidate_blocks:
                 flat_block = candidate_blocks.pop()
-                center_x, center_y, _ = tuple(flat_block.get_cog())
-                skew_center = set()
-                for cell in spread:
-                    new_cell = ((cell[X] + center_x) // 2, (cell[Y] + center_y) // 2)
-                    skew_center.add(new_cell)
-                spread |= skew_center
+                center_x, center_y, _ = (int(i) for i in flat_block.get_cog())
+                # Cells half way to the flat block's center, a box shrinks into a box
+                for (box_low_x, box_low_y), (box_high_x, box_high_y) in (box1, box2):
+                    boxes.append((((box_low_x + center_x) // 2, (box_low_y + center_y) // 2),
+                                  ((box_high_x - 1 + center_x) // 2 + 1, (box_high_y - 1 + center_y) // 2 + 1)))
+                low = (min(box_low[X] for box_low, _ in boxes), min(box_low[Y] for box_low, _ in boxes))
+                high = (max(box_high[X] for _, box_high in boxes), max(box_high[Y] for _, box_high in boxes))
+
+        spread = Cell_Mask(low, high)
+        for box_low, box_high in boxes:
+            spread.add_box(box_low, box_high)
+        self._remember_spread(ordered_pair, spread)
+        return spread
 
+    def _gen_spread_from_cells(self, block1: Block, block2: Block) -> Cell_Mask:
+        """
+        Spread of blocks which do not fill their bounding boxes, computed cell by cell. See get_spread.
+        """
+        b1_cover_x = {cell[X] for cell in block1.get_cover_cells()}
+        b2_cover_x = {cell[X] for cell in block2.get_cover_cells()}
+
+        b1_cover_y = {cell[Y] for cell in block1.get_cover_cells()}
+        b2_cover_y = {cell[Y] for cell in block2.get_cover_cells()}
+
+        inter_x = b1_cover_x & b2_cover_x
+        inter_y = b1_cover_y & b2_cover_y
+
+        spread = set()
+        spread |= block1.get_cover_cells()
+        spread |= block2.get_cover_cells()
+        if inter_x:
+            union_y = b1_cover_y | b2_cover_y
+            spread |= {(x, y) for x in inter_x for y in range(min(union_y), max(union_y) + 1)}
+
+        elif inter_y:
+            union_x = b1_cover_x | b2_cover_x
+            spread |= {(x, y) for x in range(min(union_x), max(union_x) + 1) for y in inter_y}
+
+        else:
+            candidate_blocks = set(self.get_blocks_above(block1)).intersection(self.get_blocks_above(block2))
+            if candidate_blocks:
+                center_x, center_y, _ = tuple(candidate_blocks.pop().get_cog())
+                spread |= {((cell[X] + center_x) // 2, (cell[Y] + center_y) // 2) for cell in spread}
+        return Cell_Mask.from_cells(spread)
+
+    def _remember_spread(self, ordered_pair, spread):
         self._spreads_memory[ordered_pair] = spread
-        return spread
+        if len(self._spreads_memory) > SPREADS_MEMORY_SIZE:
+            self._spreads_memory.popitem(last=False)
 
     def can_add(self, new_block: Block):
         if not Physics.is_overlapping(self, new_block): # no state changes
@@ -234,38 +481,152 @@ class Tower_State():
         self.confirm(block)
         top = block.get_top_level()
         bottom = block.get_bottom_level()
-        if top not in self._blocks_by_top_level:
-            self._blocks_by_top_level[top] = set()
-        if bottom not in self._blocks_by_bottom_level:
-            self._blocks_by_bottom_level[bottom] = set()
-        self._blocks_by_top_level[top].add(block)
-        self._blocks_by_bottom_level[bottom].add(block)
-        self._order_added.append(block)
+        assert bottom >= FLOOR_LEVEL, "Blocks can not be added below the floor"
+        self._top_level_bits |= 1 << (top - FLOOR_LEVEL)
+        self._max_height = max(self._max_height, top - bottom + 1)
+        self._blocks_by_top_level = self._blocks_by_top_level.set(
+            top, self._blocks_by_top_level.get(top, EMPTY_PSET).add(block))
+        self._blocks_by_bottom_level = self._blocks_by_bottom_level.set(
+            bottom, self._blocks_by_bottom_level.get(bottom, EMPTY_PSET).add(block))
+        self._order_added = (block, self._order_added)
+        self._occupancy = self._occupancy.add(block.get_footprint())
+        self._top_buckets = Tower_State._index_block(self._top_buckets, top, block)
+        self._bottom_buckets = Tower_State._index_block(self._bottom_buckets, bottom, block)
 
         # Make additional changes to state for fast grading
-        self._orientation_counter[Tower_State._orientation_to_index[block.orientation]] += 1
+        index = Tower_State._orientation_to_index[block.orientation]
+        counter = self._orientation_counter
+        self._orientation_counter = counter[:index] + (counter[index] + 1,) + counter[index + 1:]
         self._max_level = max(self._max_level, block.get_top_level())
-        self._gen_str()  # update string representation
+        self._hash ^= zobrist_key(block.get_key())  # update state identity
+        self._add_cover(top, block.get_cover())
+        self._stability_dirty = (block, self._stability_dirty)  # margins are measured once asked for
+        if self._mesh_buffer is not None:
+            if self._mesh_pending is None and self._mesh_length == self._mesh_buffer.length:
+                self._mesh_buffer.append(self._mesh_length, [block])
+                self._mesh_length = self._mesh_buffer.length
+            else:
+                # another state appended past this one, copy the buffer only once rendered
+                self._mesh_pending = (block, self._mesh_pending)
+
+    def _link(self, block: Block):
+        """
+        Links a block to its neighbors, without checking it is stable. See physics.is_stable
+        """
+        cover = block.get_cover()
+        self.set_blocks_below(block, Physics.calculate_below(
+            block, self.get_by_top_near(block.get_bottom_level() - 1, cover)))
+        self.set_blocks_above(block, Physics.calculate_above(
+            block, self.get_by_bottom_near(block.get_top_level() + 1, cover)))
+        self.connect_block_to_neighbors(block)
+
+    def to_bytes(self, with_connectivity=True) -> bytes:
+        """
+        Packs this state into a compact binary format: a header, the blocks' descriptors (see DESCRIPTOR_DTYPE) in the
+        order they were added, and optionally the links between them. Nothing else is kept: meshes, centers of
+        gravity and the memories of the search are all rebuilt, or recomputed on demand.
+        :param with_connectivity: keep the links between blocks, so loading need not look for neighbors
+        """
+        blocks = self._gen_order_added()
+        descriptors = np.empty(len(blocks), dtype=DESCRIPTOR_DTYPE)
+        for i, block in enumerate(blocks):
+            descriptors[i] = (ORIENTATION_TO_INDEX[block.orientation],) + tuple(block.position)
+
+        flags = 0
+        ring = (0, 0, 0)
+        if isinstance(self.floor, RingFloor):
+            flags |= SAVE_RING_FLOOR
+            ring = (self.floor._ring_size, self.floor._number_of_rings, self.floor._distance_between_rings)
+        chunks = [None, descriptors.tobytes()]
+        if with_connectivity:
+            flags |= SAVE_CONNECTIVITY
+            index = {block: i for i, block in enumerate(blocks)}
+            index[self.floor] = -1
+            links = np.array([(i, index[block_below]) for i, block in enumerate(blocks)
+                              for block_below in self.get_blocks_below(block)], dtype=LINK_DTYPE)
+            chunks.append(struct.pack('<I', len(links)))
+            chunks.append(links.tobytes())
+        chunks[0] = SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, flags, len(blocks), self.floor.get_size(), *ring)
+        return b''.join(chunks)
+
+    @staticmethod
+    def from_bytes(data: bytes, mesh=block_mesh) -> 'Tower_State':
+        """
+        Rebuilds a state saved by to_bytes. Blocks are added without checking their stability again, and their meshes
+        are only built once rendered.
+        :param mesh: the mesh of every block
+        """
+        magic, version, flags, num_of_blocks, size, *ring = SAVE_HEADER.unpack_from(data)
+        assert magic == SAVE_MAGIC and version == SAVE_VERSION, "Not a saved tower state"
+        offset = SAVE_HEADER.size
+        descriptors = np.frombuffer(data, dtype=DESCRIPTOR_DTYPE, count=num_of_blocks, offset=offset)
+        offset += descriptors.nbytes
+
+        if flags & SAVE_RING_FLOOR:
+            state = Tower_State(size, True, None, *ring)
+        else:
+            state = Tower_State(size)
+        blocks = [Block(mesh, *descriptor) for descriptor in Block.to_descriptors(descriptors)]
+        if flags & SAVE_CONNECTIVITY:
+            for block in blocks:
+                state.add(block)
+            num_of_links, = struct.unpack_from('<I', data, offset)
+            links = np.frombuffer(data, dtype=LINK_DTYPE, count=num_of_links, offset=offset + 4)
+            for i, below in links.tolist():
+                block, block_below = blocks[i], (blocks[below] if below >= 0 else state.floor)
+                state.add_block_below(block, block_below)
+                state.add_block_above(block_below, block)
+        else:
+            for block in blocks:
+                state._link(block)
+                state.add(block)
+        return state
 
-        # for level in range(bottom, top + 1):
-        #     if level not in self._cover_cells_at_level:
-        #         self._cover_cells_at_level[level] = set()
-        #     self._cover_cells_at_level[level] |= block.get_cover_cells()
+    def save(self, file_name: str, with_connectivity=True):
+        with open(file_name, 'wb') as file:
+            file.write(self.to_bytes(with_connectivity))
+
+    @staticmethod
+    def load(file_name: str, mesh=block_mesh) -> 'Tower_State':
+        with open(file_name, 'rb') as file:
+            return Tower_State.from_bytes(file.read(), mesh)
 
     def render(self, fast=False):
+        """
+        Draws the blocks of the tower, the floor excluded.
+        :param fast: Draw all blocks as a single mesh. The first fast render writes the triangles of all blocks into a
+                    buffer (see Mesh_Buffer); from then on this state and the states copied from it write the triangles
+                    of every block they add in place, and renders are views of the buffer. A state whose sibling
+                    appended first keeps its new blocks aside, and copies the buffer on its next fast render.
+        :return: A list of meshes, one per block, or a single read only mesh if fast
+        """
         if not fast:
             meshes = []
             for block in self.gen_blocks():
                 meshes.append(block.render())
-        else:
-            assert False, "fast render not yet implemented"
-        return meshes
+            return meshes
+        if self._mesh_buffer is None:
+            blocks = list(self.gen_blocks())
+            buffer = Mesh_Buffer(2 * len(blocks) * len(block_mesh.data))
+            self._mesh_buffer = buffer.append(0, blocks)
+            self._mesh_length = self._mesh_buffer.length
+        elif self._mesh_pending is not None:
+            blocks = []
+            pending = self._mesh_pending
+            while pending is not None:
+                block, pending = pending
+                blocks.append(block)
+            self._mesh_pending = None
+            self._mesh_buffer = self._mesh_buffer.append(self._mesh_length, blocks[::-1])
+            self._mesh_length = self._mesh_buffer.length
+        return self._mesh_buffer.view(self._mesh_length)
 
     def get_orientation_vector(self):
-        s = np.sum(self._orientation_counter)
+        counter = np.array(self._orientation_counter, dtype=float)
+        s = np.sum(counter)
         if s != 0:
-            return self._orientation_counter / s
-        return self._orientation_counter
+            return counter / s
+        return counter
 
     def get_top_off(self) -> int:
         """
@@ -276,10 +637,78 @@ class Tower_State():
 
     def get_stability_index(self) -> float:
         """
-        Returns a value representing how close this tower is to instability
-        :return:
+        Returns a value representing how close this tower is to instability: the least stability margin of all its
+        blocks, in cells (see Physics.get_stability_margin). Adding a block only marks it, margins are measured
+        along the support paths of the blocks added since the last call. Without new blocks, a lookup.
+        :return: The least margin, infinite when all blocks stand on the floor
         """
-        assert False, "Stability Index not yet implemented"
+        self._measure_stability()
+        return self._stability_index
+
+    def get_stability_margin(self, block: Block) -> float:
+        """
+        :return: The stability margin of an added block, infinite for blocks on the floor
+        """
+        self._measure_stability()
+        return self._stability_margins.get(block, math.inf)
+
+    def _measure_stability(self):
+        if self._stability_dirty is None:
+            return
+        blocks = []
+        dirty = self._stability_dirty
+        while dirty is not None:
+            block, dirty = dirty
+            blocks.append(block)
+        self._stability_dirty = None
+        self._update_stability(self._gen_support_paths(blocks))
+
+    def _gen_support_paths(self, blocks: List[Block]) -> Generator[Block, None, None]:
+        """
+        The blocks whose stability margin changes with new blocks, each once: the blocks themselves, the blocks resting
+        on them (their support grew), and every block carrying them, whose aggregate center of gravity moved.
+        """
+        visited = set()
+        stack = list(blocks)
+        while stack:
+            block = stack.pop()
+            if block is self.floor or block in visited:
+                continue
+            visited.add(block)
+            yield block
+            stack.extend(self.get_blocks_below(block))
+        for block in blocks:
+            for block_above in self.get_blocks_above(block):
+                if block_above not in visited:
+                    visited.add(block_above)
+                    yield block_above
+
+    def _update_stability(self, blocks: Iterable[Block]):
+        """
+        Measures the stability margin of the given blocks again, and updates the least margin. Only when the least
+        stable block grew more stable are all margins visited.
+        """
+        margins = self._stability_margins
+        index, least_stable = self._stability_index, self._least_stable
+        rescan = False
+        # Aggregate masses shared by the blocks measured, a block carrying another is measured only once
+        aggregates = dict()
+        for block in blocks:
+            margin = Physics.get_stability_margin(self, block, aggregates)
+            if margin == math.inf:
+                continue
+            margins = margins.set(block, margin)
+            if margin < index:
+                index, least_stable = margin, block
+            elif block is least_stable and margin > index:
+                rescan = True
+        if rescan:
+            index, least_stable = math.inf, None
+            for block, margin in margins.items():
+                if margin < index:
+                    index, least_stable = margin, block
+        self._stability_margins = margins
+        self._stability_index, self._least_stable = index, least_stable
 
     def connect_block_to_neighbors(self, catalyst_block: Block):
         """
@@ -315,7 +744,7 @@ class Tower_State():
         for neighbor_block in self.get_blocks_above(catalyst_block):
             self.remove_block_below(neighbor_block, catalyst_block)
 
-        del self._connectivity[catalyst_block]
+        self._connectivity = self._connectivity.remove(catalyst_block)
 
     def confirm(self, block):
         # an added block is also a bad block, a block which should never be revisited again.
@@ -343,196 +772,197 @@ class Tower_State():
         :param blocks: A list of existing blocks to link as supports
         :return:
         """
-        if block not in self._connectivity:
-            if self._father_state:
-                above = self._father_state.get_blocks_above(block)
-            else:
-                above = set()
-            self._connectivity[block] = [set(), above]
-        self._connectivity[block][NEIGHBOR_BELOW] = blocks
+        _, above, covered = self._connectivity.get(block, _NO_NEIGHBORS)
+        self._connectivity = self._connectivity.set(block, (tuple(blocks), above, covered))
 
     def set_blocks_above(self, block: Block, blocks: Set[Block] ):
-        if block not in self._connectivity:
-            if self._father_state:
-                below = self._father_state.get_blocks_above(block)
-            else:
-                below = set()
-            self._connectivity[block] = [below, set()]
-        self._connectivity[block][NEIGHBOR_ABOVE] = blocks
-
-    def get_blocks_below(self, block: Block) -> Set[Block]:
-        if block in self._connectivity:
-            return self._connectivity[block][NEIGHBOR_BELOW]
-        if self._father_state:
-            below = self._father_state.get_blocks_below(block)
-            above = self._father_state.get_blocks_above(block)
-            if below == None:
-                # print("Called get blocks below with no block... {}".format(str(block)))
-                below = set()
-            if above == None:
-                # print("Called get blocks below with no block... {}".format(str(block)))
-                above = set()
-            self._connectivity[block] = [below, above]
-            return below
-
-    def get_blocks_above(self, block: Block) -> Set[Block]:
-        if block in self._connectivity:
-            return self._connectivity[block][NEIGHBOR_ABOVE]
-        if self._father_state:
-            below = self._father_state.get_blocks_below(block)
-            above = self._father_state.get_blocks_above(block)
-            if below == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                below = set()
-            if above == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                above = set()
-            self._connectivity[block] = [below, above]
-            return above
+        cover = block.get_cover()
+        covered = sum(cover.intersection_size(block_above.get_cover()) for block_above in blocks)
+        self._connectivity = self._connectivity.set(block, (self.get_blocks_below(block), tuple(blocks), covered))
+
+    def get_covered_cells(self, block: Block) -> int:
+        """
+        Blocks directly above a block all share the same bottom level, so their covers never overlap. The number of
+        covered cells is therefore kept as a running sum as blocks are linked and unlinked above the block.
+        :return: Number of cover cells of the given block, covered by blocks directly above it
+        """
+        return self._connectivity.get(block, _NO_NEIGHBORS)[COVERED_CELLS]
+
+    def get_blocks_below(self, block: Block) -> Tuple[Block, ...]:
+        return self._connectivity.get(block, _NO_NEIGHBORS)[NEIGHBOR_BELOW]
+
+    def get_blocks_above(self, block: Block) -> Tuple[Block, ...]:
+        return self._connectivity.get(block, _NO_NEIGHBORS)[NEIGHBOR_ABOVE]
 
     def add_block_below(self, block: Block, block_below: Block):
-        if block in self._connectivity:
-            self._connectivity[block][NEIGHBOR_BELOW].add(block_below)
-            return
-        if self._father_state:
-            below = self._father_state.get_blocks_below(block)
-            above = self._father_state.get_blocks_above(block)
-            if below == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                below = set()
-            if above == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                above = set()
-            self._connectivity[block] = [below, above]
-            self._connectivity[block][NEIGHBOR_BELOW].add(block_below)
-            return
-        self._connectivity[block] = [{block_below,}, set()]
+        below, above, covered = self._connectivity.get(block, _NO_NEIGHBORS)
+        if block_below not in below:
+            self._connectivity = self._connectivity.set(block, (below + (block_below,), above, covered))
 
     def add_block_above(self, block: Block, block_above: Block):
-        if block in self._connectivity:
-            self._connectivity[block][NEIGHBOR_ABOVE].add(block_above)
-            return
-        if self._father_state:
-            below = self._father_state.get_blocks_below(block)
-            above = self._father_state.get_blocks_above(block)
-            if below == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                below = set()
-            if above == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                above = set()
-            self._connectivity[block] = [below, above]
-            self._connectivity[block][NEIGHBOR_ABOVE].add(block_above)
-            return
-        self._connectivity[block] = [set(), {block_above,}]
+        below, above, covered = self._connectivity.get(block, _NO_NEIGHBORS)
+        if block_above not in above:
+            covered += block.get_cover().intersection_size(block_above.get_cover())
+            self._connectivity = self._connectivity.set(block, (below, above + (block_above,), covered))
 
     def remove_block_below(self, block: Block, block_below: Block):
-        if block in self._connectivity:
-            self._connectivity[block][NEIGHBOR_BELOW].remove(block_below)
-            return
-        if self._father_state:
-            below = self._father_state.get_blocks_below(block)
-            above = self._father_state.get_blocks_above(block)
-            if below == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                below = set()
-            if above == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                above = set()
-            self._connectivity[block] = [below, above]
-            self._connectivity[block][NEIGHBOR_BELOW].remove(block_below)
-            return
-        self._connectivity[block] = [set(), set()]
+        below, above, covered = self._connectivity.get(block, _NO_NEIGHBORS)
+        assert block_below in below
+        self._connectivity = self._connectivity.set(
+            block, (tuple(b for b in below if b != block_below), above, covered))
 
     def remove_block_above(self, block: Block, block_above: Block):
-        if block in self._connectivity:
-            self._connectivity[block][NEIGHBOR_ABOVE].remove(block_above)
-            return
-        if self._father_state:
-            below = self._father_state.get_blocks_below(block)
-            above = self._father_state.get_blocks_above(block)
-            if below == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                below = set()
-            if above == None:
-                # print("Called get blocks above with no block... {}".format(str(block)))
-                above = set()
-            self._connectivity[block] = [below, above]
-            self._connectivity[block][NEIGHBOR_ABOVE].remove(block_above)
-            return
-        self._connectivity[block] = [set(), set()]
+        below, above, covered = self._connectivity.get(block, _NO_NEIGHBORS)
+        assert block_above in above
+        covered -= block.get_cover().intersection_size(block_above.get_cover())
+        self._connectivity = self._connectivity.set(
+            block, (below, tuple(b for b in above if b != block_above), covered))
 
-    def _gen_str(self):
-        self._str = str(sorted(list(self.gen_blocks())))
+    def _gen_key(self) -> Tuple[int, ...]:
+        """
+        A state is identified by the sorted keys of all its blocks
+        """
+        return tuple(sorted(block.get_key() for block in self.gen_blocks()))
 
     def __str__(self):
-        return self._str
+        return str(sorted(list(self.gen_blocks())))
 
     def __repr__(self):
         return self.__str__()
 
     def __hash__(self):
-        return hash(self.__str__())
+        return self._hash
 
     def __eq__(self, other):
-        return self.__str__() == other.__str__()
+        # Full keys are only compared when hashes collide, or when both states hold the same blocks
+        return isinstance(other, Tower_State) and self._hash == other._hash and \
+               (self._order_added is other._order_added or self._gen_key() == other._gen_key())
 
     def __copy__(self):
         """
-        This function needed to be meticulously designed so that copies would be skeletal, and light at possible.
-        Therefore, no deep-copies are used. Characteristics that are unique to a tower state and all its sons are
-        kept through use of recursion.
+        Copies are skeletal: all containers are persistent, so a copy shares them with this state as they are, in
+        O(1). Changes to the copy build new versions of its own containers and never reach this state.
         :return:
         """
-        # It is important to emphasize that a copied state is only a replica as a son of this father state.
-        copied_state = Tower_State(self.floor.get_size(), father_state=self)
+        copied_state = Tower_State.__new__(Tower_State)
         copied_state.floor                   = self.floor
+        copied_state._bad_block_calls        = self._bad_block_calls
+        copied_state._order_added            = self._order_added
         copied_state._max_level              = self._max_level
-        copied_state._orientation_counter    = copy(self._orientation_counter)
+        copied_state._blocks_by_top_level    = self._blocks_by_top_level
+        copied_state._blocks_by_bottom_level = self._blocks_by_bottom_level
+        copied_state._top_level_bits         = self._top_level_bits
+        copied_state._max_height             = self._max_height
+        copied_state._connectivity           = self._connectivity
+        copied_state._occupancy              = self._occupancy
+        copied_state._top_buckets            = self._top_buckets
+        copied_state._bottom_buckets         = self._bottom_buckets
+        copied_state._orientation_counter    = self._orientation_counter
+        copied_state._bad_block_hashes       = self._bad_block_hashes
         copied_state._spreads_memory         = self._spreads_memory # invarient of state
-        copied_state._bad_block_calls        = self._bad_block_calls
-
+        copied_state._nogoods                = self._nogoods # shared by the whole search
+        copied_state._hash                   = self._hash
+        copied_state._cover_by_top           = self._cover_by_top
+        copied_state._ring_covers            = self._ring_covers
+        copied_state._starting_cover_size    = self._starting_cover_size
+        copied_state._stability_margins      = self._stability_margins
+        copied_state._stability_index        = self._stability_index
+        copied_state._least_stable           = self._least_stable
+        copied_state._stability_dirty        = self._stability_dirty
+        copied_state._mesh_buffer            = self._mesh_buffer
+        copied_state._mesh_length            = self._mesh_length
+        copied_state._mesh_pending           = self._mesh_pending
         return copied_state
 
-    def get_by_top(self, level):
-        s = set()
-        if level in self._blocks_by_top_level:
-            s |= self._blocks_by_top_level[level]
-        if self._father_state and level not in self._updated_top:
-            s |= self._father_state.get_by_top(level)
-            self._blocks_by_top_level[level] = s
-            self._updated_top.add(level)
-        return s
-
-    def get_by_bottom(self, level):
-        s = set()
-        if level in self._blocks_by_bottom_level:
-            s |= self._blocks_by_bottom_level[level]
-        if self._father_state and level not in self._updated_bottom:
-            s |= self._father_state.get_by_bottom(level)
-            self._blocks_by_bottom_level[level] = s
-            self._updated_bottom.add(level)
-        return s
-
-    def __contains__(self, item):
-        if item in self._mem:
-            return True
-
-        if item in self._blocks_by_bottom_level or item in self._blocks_by_top_level:
-            self._mem.add(item)
-            return True
-
-        if self._father_state and item in self._father_state:
+    def overlaps(self, block: Block) -> bool:
+        """
+        :return: True iff the given block occupies a cell already occupied by the floor or an added block
+        """
+        # Only blocks reaching down into the floor's levels may meet it, and a floor is answered from its bounds
+        footprint = block.get_footprint()
+        if block.get_bottom_level() <= self.floor.get_top_level() and footprint.intersects(self.floor.get_footprint()):
             return True
-        return False
+        return self._occupancy.intersects(footprint)
 
+    @staticmethod
+    def _gen_buckets(level: int, cover) -> Generator[Tuple[int, int, int], None, None]:
+        """
+        :param cover: 2D footprint
+        :return: All the buckets of the given level that the cover's bounding box touches
+        """
+        (low_x, low_y), (high_x, high_y) = cover.get_origin(), cover.get_end()
+        for bucket_x in range(low_x >> SPATIAL_BUCKET_BITS, ((high_x - 1) >> SPATIAL_BUCKET_BITS) + 1):
+            for bucket_y in range(low_y >> SPATIAL_BUCKET_BITS, ((high_y - 1) >> SPATIAL_BUCKET_BITS) + 1):
+                yield level, bucket_x, bucket_y
+
+    @staticmethod
+    def _index_block(buckets: PMap, level: int, block: Block) -> PMap:
+        for bucket in Tower_State._gen_buckets(level, block.get_cover()):
+            buckets = buckets.set(bucket, buckets.get(bucket, EMPTY_PSET).add(block))
+        return buckets
+
+    def _get_near(self, buckets: PMap, level: int, cover) -> Set[Block]:
+        near = set()
+        for bucket in Tower_State._gen_buckets(level, cover):
+            near.update(buckets.get(bucket, EMPTY_PSET))
+        return near
+
+    def get_by_top_near(self, level: int, cover) -> Set[Block]:
+        """
+        Blocks never leave a state (disconnecting a block only unlinks its neighbors), so the index only grows on add.
+        :param cover: 2D footprint
+        :return: Blocks with the given top level, whose covers may share cells with the given cover. A superset of
+                 the blocks that do, containing only blocks close to the cover. The floor is only included when its
+                 cover shares cells with the given cover.
+        """
+        near = self._get_near(self._top_buckets, level, cover)
+        if level == self.floor.get_top_level() and cover.intersects(self.floor.get_cover()):
+            near.add(self.floor)
+        return near
 
-    def keys(self):
-        if self._father_state:
-            return self._blocks_by_top_level.keys() | self._father_state.keys()
-        return self._blocks_by_top_level.keys()
+    def get_by_bottom_near(self, level: int, cover) -> Set[Block]:
+        """
+        Same as get_by_top_near, for blocks with the given bottom level
+        """
+        return self._get_near(self._bottom_buckets, level, cover)
 
+    def get_by_top(self, level) -> PSet:
+        return self._blocks_by_top_level.get(level, EMPTY_PSET)
 
+    def get_by_bottom(self, level) -> PSet:
+        return self._blocks_by_bottom_level.get(level, EMPTY_PSET)
 
+    def __contains__(self, item):
+        return item in self._blocks_by_bottom_level or item in self._blocks_by_top_level
 
+    def gen_blocks_between(self, low: int, high: int) -> Generator[Block, None, None]:
+        """
+        Blocks whose levels [bottom, top] intersect [low, high], the floor included. No block is taller than the
+        tallest block, so only top levels in [low, high + tallest - 1] are visited, read off the bits of the levels
+        in use: O(k) besides a few word operations.
+        """
+        low = max(low, FLOOR_LEVEL)
+        high_top = high + self._max_height - 1
+        if high_top < low:
+            return
+        for level in Tower_State._gen_levels(self._top_level_bits >> (low - FLOOR_LEVEL) &
+                                             ((1 << (high_top - low + 1)) - 1), low):
+            for block in self._blocks_by_top_level[level]:
+                if block.get_bottom_level() <= high:
+                    yield block
+
+    @staticmethod
+    def _gen_levels(bits: int, first_level: int) -> Generator[int, None, None]:
+        """
+        :return: The level of every set bit, bit 0 stands for first_level
+        """
+        while bits:
+            lowest = bits & -bits
+            yield first_level + lowest.bit_length() - 1
+            bits ^= lowest
 
+    def keys(self) -> Tuple[int, ...]:
+        """
+        :return: All top levels in use, sorted
+        """
+        return tuple(Tower_State._gen_levels(self._top_level_bits, FLOOR_LEVEL))